@@ -6,15 +6,105 @@ import os
 from flask import Flask
 
 
-def create_app(test_config=None):
-    """Create and configure an instance of the Flask application."""
+def create_app(test_config=None, instance_path=None):
+    """Create and configure an instance of the Flask application. The instance
+    folder can be moved elsewhere with ``instance_path``, such as for tests.
+    """
 
-    app = Flask(__name__, instance_relative_config=True)
+    app = Flask(__name__, instance_path=instance_path, instance_relative_config=True)
     app.config.from_mapping(
         # A default secret key that should be overridden by instance config
         SECRET_KEY="dev",
         # Store the database in the instance folder
         DATABASE=os.path.join(app.instance_path, "my-anime-collection.sqlite"),
+        # Number of idle database connections each process keeps open for reuse
+        DATABASE_POOL_SIZE=8,
+        # Number of prepared statements each database connection keeps cached
+        DATABASE_CACHED_STATEMENTS=256,
+        # Milliseconds to wait for a database lock before giving up
+        DATABASE_BUSY_TIMEOUT=5000,
+        # Bytes of the database file to memory-map, and KiB of page cache (when negative)
+        DATABASE_MMAP_SIZE=256 * 1024 * 1024,
+        DATABASE_CACHE_SIZE=-16000,
+        # Seconds a logged in user is cached for, and how many users are cached
+        USER_CACHE_TTL=60,
+        USER_CACHE_SIZE=10000,
+        # Method used to hash passwords, as accepted by Werkzeug's generate_password_hash().
+        # Passwords hashed with other settings are hashed again when their user logs in
+        PASSWORD_HASH_METHOD="scrypt:32768:8:1",
+        # Threads hashing passwords in each process, and how many hashes may be
+        # running or waiting before new logins are turned away
+        PASSWORD_HASH_WORKERS=2,
+        PASSWORD_HASH_QUEUE=16,
+        # Location of the anime-reports.xml catalog obtained from the ANN API
+        CATALOG_XML=os.path.join(app.instance_path, "anime-reports.xml"),
+        # Number of anime inserted per transaction when importing the catalog
+        IMPORT_BATCH_SIZE=5000,
+        # Journal settings used while importing the catalog
+        IMPORT_JOURNAL_MODE="WAL",
+        IMPORT_SYNCHRONOUS="OFF",
+        # Maximum releases sharing words with an imported row's title that are
+        # compared to it, to find the release the row refers to
+        IMPORT_MATCH_CANDIDATES=500,
+        # Maximum number of anime returned by a title search
+        SEARCH_RESULT_LIMIT=100,
+        # Maximum number of anime suggested while typing a title
+        TYPEAHEAD_LIMIT=10,
+        # Number of releases shown on each page of a user's collection
+        COLLECTION_PAGE_SIZE=50,
+        # Where rendered collection pages are cached: "memory" for each process's
+        # own memory, keeping up to PAGE_CACHE_SIZE pages, "filesystem" for the
+        # instance folder, or None to not cache them
+        PAGE_CACHE="memory",
+        PAGE_CACHE_SIZE=1024,
+        # Maximum releases in each page of the collection listed by the JSON API,
+        # and maximum releases added, changed, or removed by one API request
+        API_PAGE_SIZE=500,
+        API_BATCH_SIZE=1000,
+        # ANN encyclopedia API, and how to call it
+        ANN_API_URL="https://cdn.animenewsnetwork.com/encyclopedia/api.xml",
+        # Seconds to wait for ANN to respond
+        ANN_TIMEOUT=10,
+        # Times to retry a failed request, waiting ANN_BACKOFF seconds, doubling each time
+        ANN_RETRIES=3,
+        ANN_BACKOFF=0.5,
+        # Seconds after which a request to ANN gives up, including any retries
+        ANN_DEADLINE=15,
+        # Maximum requests to ANN each process makes at the same time
+        ANN_CONCURRENCY=4,
+        # Maximum anime requested from ANN in one call
+        ANN_BATCH_SIZE=50,
+        # Seconds before an anime's stored releases are refreshed from ANN, and
+        # how many background threads do the refreshing
+        RELEASES_TTL=7 * 24 * 60 * 60,
+        RELEASES_REFRESH_WORKERS=2,
+        # Size in pixels release images are shown at, bytes of images kept in
+        # the cache, and seconds browsers may cache an image for
+        THUMBNAIL_SIZE=(100, 150),
+        THUMBNAIL_CACHE_SIZE=256 * 1024 * 1024,
+        THUMBNAIL_MAX_AGE=30 * 24 * 60 * 60,
+        # Maximum calls to ANN per second when fetching releases ahead of time
+        WARM_RELEASES_RATE=1.0,
+        # Fetch releases ahead of time in a background thread of the web server,
+        # checking for new anime every WARM_RELEASES_IDLE seconds once done
+        WARM_RELEASES_IN_BACKGROUND=False,
+        WARM_RELEASES_IDLE=3600,
+        # Record the SQL statements, ANN calls, and template rendering of each
+        # request, served at /metrics and in a Server-Timing header
+        INSTRUMENTATION=False,
+        # Number of slowest statements reported at /metrics, and times a request
+        # may run the same statement before a warning is logged
+        INSTRUMENTATION_SLOWEST=20,
+        INSTRUMENTATION_REPEAT_LIMIT=10,
+        # /metrics shows timings and the text of the slowest statements, so it is
+        # only served to requests sending METRICS_TOKEN as a bearer token, or,
+        # without a token, to requests from METRICS_ALLOWED_ADDRESSES. Behind a
+        # reverse proxy every request comes from the proxy's address, so set a token there
+        METRICS_TOKEN=None,
+        METRICS_ALLOWED_ADDRESSES=["127.0.0.1", "::1"],
+        # Keep compiled templates in the instance folder, so that new processes
+        # load them instead of compiling them again
+        TEMPLATE_BYTECODE_CACHE=True,
     )
 
     if test_config is None:
@@ -34,12 +124,49 @@ def create_app(test_config=None):
     from . import db
     db.initialize_app(app)
 
+    # Record where requests spend their time, if enabled. Registered first, so
+    # that everything done for a request is recorded
+    from . import instrumentation
+    instrumentation.initialize_app(app)
+
+    # Cache compiled templates, and register the commands that check how fast the app starts
+    from . import startup
+    startup.initialize_app(app)
+
     # Import and register the "auth" blueprint
     from . import auth
     app.register_blueprint(auth.blueprint)
 
+    # Register the password hashing benchmark command
+    from . import passwords
+    passwords.initialize_app(app)
+
     from . import collection
     app.register_blueprint(collection.blueprint)
     app.add_url_rule("/", endpoint="index")
 
+    # Import and export collections in bulk
+    from . import bulk
+    app.register_blueprint(bulk.blueprint)
+
+    # Serve the JSON API used by other clients than the browser
+    from . import api
+    app.register_blueprint(api.blueprint)
+
+    # Serve statistics about collections
+    from . import stats
+    app.register_blueprint(stats.blueprint)
+
+    # Serve release images from a local cache
+    from . import thumbnails
+    app.register_blueprint(thumbnails.blueprint)
+
+    # Register the command, and optional worker, that fetch releases ahead of time
+    from . import warm
+    warm.initialize_app(app)
+
+    # Register the commands that generate a dataset and benchmark the app with it
+    from . import benchmark
+    benchmark.initialize_app(app)
+
     return app
@@ -0,0 +1,229 @@
+# Client for the AnimeNewsNetwork (ANN) encyclopedia API:
+# https://www.animenewsnetwork.com/encyclopedia/api.php
+
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+import xml.etree.ElementTree as ET
+
+from mac import instrumentation
+
+# Each thread keeps its connection to ANN open between requests
+connections = threading.local()
+
+# Limits how many requests to ANN this process makes at the same time
+semaphore = None
+semaphore_lock = threading.Lock()
+
+# Threads requesting batches of anime at the same time, kept for the life of
+# the process along with their connections, as (pid, executor)
+executor = None
+executor_lock = threading.Lock()
+
+
+class FetchError(Exception):
+    """Raised when ANN could not be reached, even after retrying."""
+
+
+def get_settings():
+    """Read the ANN client's settings from the application's config, so that
+    they can be used from threads without an application context.
+    """
+
+    config = current_app.config
+
+    return {"url": config["ANN_API_URL"],
+            "timeout": config["ANN_TIMEOUT"],
+            "retries": config["ANN_RETRIES"],
+            "backoff": config["ANN_BACKOFF"],
+            "deadline": config["ANN_DEADLINE"],
+            "concurrency": config["ANN_CONCURRENCY"],
+            "batch_size": config["ANN_BATCH_SIZE"]}
+
+
+def get_semaphore(concurrency):
+    """Return the semaphore limiting this process's concurrent requests to ANN."""
+
+    global semaphore
+
+    if semaphore is None:
+        with semaphore_lock:
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(concurrency)
+
+    return semaphore
+
+
+def get_executor(concurrency):
+    """Return this process's threads for requesting batches from ANN. Worker
+    processes forked from a parent start threads of their own.
+    """
+
+    global executor
+
+    if executor is None or executor[0] != os.getpid():
+        with executor_lock:
+            if executor is None or executor[0] != os.getpid():
+                executor = (os.getpid(), ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="ann"))
+
+    return executor[1]
+
+
+def get_connection(url, timeout):
+    """Return this thread's open connection to the host in ``url``, opening
+    one if needed.
+    """
+
+    key = (url.scheme, url.netloc)
+    connection = getattr(connections, "connection", None)
+
+    if connection is None or connections.key != key:
+        if connection is not None:
+            connection.close()
+
+        if url.scheme == "https":
+            connection = http.client.HTTPSConnection(url.netloc, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(url.netloc, timeout=timeout)
+
+        connections.connection = connection
+        connections.key = key
+
+    return connection
+
+
+def close_connection():
+    """Close this thread's connection to ANN, so the next request opens a new one."""
+
+    connection = getattr(connections, "connection", None)
+
+    if connection is not None:
+        connection.close()
+        connections.connection = None
+
+
+def request(ids, settings):
+    """Request the data of every anime in ``ids`` from ANN in a single call, and
+    return the response body.
+    """
+
+    return get(f"{settings['url']}?anime={'/'.join(str(id) for id in ids)}", settings)
+
+
+def attempt(url, path, timeout):
+    """Make one request to ANN, and return the response's status and body."""
+
+    connection = get_connection(url, timeout)
+
+    # The connection may have been opened by an earlier request with more time left
+    connection.timeout = timeout
+
+    if connection.sock is not None:
+        connection.sock.settimeout(timeout)
+
+    connection.request("GET", path)
+    response = connection.getresponse()
+
+    return response.status, response.read()
+
+
+def get(url, settings):
+    """Request ``url`` from ANN and return the response body. Retries with
+    exponential backoff when ANN cannot be reached or responds with a server
+    error, but gives up once ANN_DEADLINE seconds have passed.
+    """
+
+    url = urllib.parse.urlsplit(url)
+    path = f"{url.path}?{url.query}" if url.query else url.path
+
+    deadline = time.monotonic() + settings["deadline"]
+    semaphore = get_semaphore(settings["concurrency"])
+    error = None
+    attempts = 0
+
+    for number in range(settings["retries"] + 1):
+        # Wait longer before each new attempt, unless that would pass the deadline
+        if number:
+            delay = settings["backoff"] * 2 ** (number - 1)
+
+            if time.monotonic() + delay >= deadline:
+                break
+
+            time.sleep(delay)
+
+        remaining = deadline - time.monotonic()
+
+        # The semaphore is only held during each attempt, so that requests
+        # waiting to retry don't keep others from calling ANN
+        if not semaphore.acquire(timeout=remaining):
+            error = "too many other requests to ANN were in progress"
+            break
+
+        attempts += 1
+
+        try:
+            status, body = attempt(url, path, min(settings["timeout"], remaining))
+        except (OSError, http.client.HTTPException) as exception:
+            # The connection can't be reused after a failed request
+            close_connection()
+            error = exception
+            continue
+        finally:
+            semaphore.release()
+
+        # Retry if ANN is overloaded or failed, but not if the request was wrong
+        if status == 429 or status >= 500:
+            error = f"ANN responded with status {status}"
+            continue
+        if status != 200:
+            raise FetchError(f"ANN responded with status {status}")
+
+        return body
+
+    raise FetchError(f"Could not reach ANN after {attempts} attempts: {error}")
+
+
+def fetch_anime(ids):
+    """Fetch the data of every anime in ``ids`` from ANN, in batches that are
+    requested concurrently. Returns a dict of each anime's id to its <anime>
+    element, leaving out any anime ANN has no data for.
+    """
+
+    settings = get_settings()
+    ids = list(ids)
+
+    if not ids:
+        return {}
+
+    # Time spent waiting on ANN is reported with the request's timings
+    with instrumentation.timer("ann"):
+        # Split ids into batches, each of which is requested in one call to ANN
+        batches = [ids[start:start + settings["batch_size"]]
+                   for start in range(0, len(ids), settings["batch_size"])]
+
+        # Avoid starting threads when there's only one request to make
+        if len(batches) == 1:
+            responses = [request(batches[0], settings)]
+        else:
+            responses = list(get_executor(settings["concurrency"]).map(lambda batch: request(batch, settings),
+                                                                        batches))
+
+    anime = {}
+
+    for response in responses:
+        for element in ET.fromstring(response).findall("anime"):
+            anime[int(element.get("id"))] = element
+
+    return anime
+
+
+def fetch_image(url):
+    """Fetch an image, such as a release's thumbnail, from ANN's CDN."""
+
+    with instrumentation.timer("ann"):
+        return get(url, get_settings())
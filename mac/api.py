@@ -0,0 +1,390 @@
+import functools
+import hashlib
+import secrets
+
+import click
+from flask import Blueprint, current_app, g, jsonify, request
+from werkzeug.exceptions import HTTPException, abort
+
+from mac import queries
+from mac.auth import user_not_needed
+from mac.bulk import get_user_id, parse_date, parse_price
+from mac.cache import bump_collection_version
+from mac.db import get_database
+from mac.passwords import check_password
+
+# Create "api" blueprint for the JSON API, whose commands are called directly as "flask <command>".
+# Its URLs carry a version, so that clients keep working when a later version changes them
+blueprint = Blueprint("api", __name__, url_prefix="/api/v1", cli_group=None)
+
+# Fields of a release in a collection that clients may change
+EDITABLE_FIELDS = ["price_bought", "date_bought", "store_bought", "comment"]
+
+
+def hash_token(token):
+    """Return the hash a token is stored as. Tokens are long and random, so a
+    fast hash is enough.
+    """
+
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_token(database, user_id):
+    """Create a new API token for a user, and return it."""
+
+    token = secrets.token_urlsafe(32)
+
+    database.execute("INSERT INTO api_tokens (token_hash, user_id) VALUES (?, ?)",
+                     [hash_token(token), user_id])
+    database.commit()
+
+    return token
+
+
+def get_token():
+    """Return the token sent in the request's "Authorization: Bearer" header,
+    or None if there isn't one.
+    """
+
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+
+    return token.strip()
+
+
+def api_login_required(view):
+    """View decorator that requires users to be logged in, either with the
+    session cookie or with an API token. Responds with 401 Unauthorized instead
+    of redirecting to the login page.
+    """
+
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        token = get_token()
+
+        # A token takes precedence over the session cookie
+        if token is not None:
+            user = get_database().execute(queries.SELECT_TOKEN_USER, [hash_token(token)]).fetchone()
+
+            g.user = None if user is None else dict(user)
+
+        if g.user is None:
+            abort(401)
+
+        return view(**kwargs)
+
+    return wrapped_view
+
+
+@blueprint.errorhandler(HTTPException)
+def handle_error(error):
+    """Respond to errors in API views with JSON instead of an HTML page."""
+
+    response = error.get_response()
+    response.data = current_app.json.dumps({"error": error.description})
+    response.content_type = "application/json"
+
+    return response
+
+
+def get_items():
+    """Return the list of items in the request's JSON body, aborting with
+    400 Bad Request if it is missing or longer than the configured maximum.
+    """
+
+    body = request.get_json(silent=True)
+    items = body.get("items") if isinstance(body, dict) else None
+
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        abort(400, 'Send a JSON object with a list of objects under "items".')
+
+    if len(items) > current_app.config["API_BATCH_SIZE"]:
+        abort(400, f"Send at most {current_app.config['API_BATCH_SIZE']} items at once.")
+
+    return items
+
+
+def get_release_ids(items):
+    """Return the release_id of each item, aborting with 400 Bad Request if any
+    item doesn't have one.
+    """
+
+    release_ids = [item.get("release_id") for item in items]
+
+    if not all(isinstance(release_id, int) and not isinstance(release_id, bool) for release_id in release_ids):
+        abort(400, 'Every item needs a numeric "release_id".')
+
+    return release_ids
+
+
+def parse_values(item):
+    """Return the editable fields given in an item, as they are stored.
+    Aborts with 400 Bad Request if a value is invalid.
+    """
+
+    values = {field: item[field] for field in EDITABLE_FIELDS if field in item}
+
+    # Values may be numbers in JSON, but are stored like values entered on the edit page
+    for field, value in values.items():
+        values[field] = None if value is None else str(value)
+
+    try:
+        if "price_bought" in values:
+            values["price_bought"] = parse_price(values["price_bought"])
+        if "date_bought" in values:
+            values["date_bought"] = parse_date(values["date_bought"])
+    except ValueError as error:
+        abort(400, f"Release {item['release_id']}: {error}")
+
+    return values
+
+
+def get_existing(database, user_id, release_ids):
+    """Return the set of ``release_ids`` that are in the user's collection."""
+
+    if not release_ids:
+        return set()
+
+    return {row["release_id"] for row in database.execute(queries.select_existing(len(release_ids)),
+                                                          [user_id, *release_ids])}
+
+
+def to_json(row, fields):
+    """Return ``fields`` of a release read from the database as a dict,
+    with dates in ISO 8601 format.
+    """
+
+    release = {field: row[field] for field in fields}
+
+    if release.get("date_added") is not None:
+        release["date_added"] = release["date_added"].isoformat()
+
+    return release
+
+
+def get_fields():
+    """Return the fields asked for with the "fields" query parameter, or all of
+    them. Aborts with 400 Bad Request if an unknown field is asked for.
+    """
+
+    fields = [field for field in request.args.get("fields", "").split(",") if field]
+
+    if not fields:
+        return list(queries.COLLECTION_FIELDS)
+
+    unknown = [field for field in fields if field not in queries.COLLECTION_FIELDS]
+
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}.")
+
+    return fields
+
+
+@blueprint.route("/tokens", methods=["POST"])
+@user_not_needed
+def create_token_view():
+    """Log in with a username and password sent as JSON, and respond with
+    a new API token for the user.
+    """
+
+    body = request.get_json(silent=True)
+    username = body.get("username") if isinstance(body, dict) else None
+    password = body.get("password") if isinstance(body, dict) else None
+
+    if not isinstance(username, str) or not isinstance(password, str):
+        abort(400, "Send a JSON object with a username and password.")
+
+    database = get_database()
+
+    user = database.execute(queries.SELECT_USER_BY_USERNAME, [username]).fetchone()
+
+    if user is None or not check_password(user["password"], password):
+        abort(401, "Username or password is incorrect.")
+
+    return jsonify({"token": create_token(database, user["user_id"])}), 201
+
+
+@blueprint.route("/tokens", methods=["DELETE"])
+@user_not_needed
+def revoke_token():
+    """Revoke the API token the request was sent with."""
+
+    token = get_token()
+
+    if token is None:
+        abort(401)
+
+    database = get_database()
+    database.execute(queries.DELETE_TOKEN, [hash_token(token)])
+    database.commit()
+
+    return "", 204
+
+
+@blueprint.route("/collection")
+@api_login_required
+def list_collection():
+    """List one page of the releases in the user's collection, ordered by
+    release_id. Pass "cursor" from the previous page to get the next one, and
+    "fields" to only get some fields of each release.
+    """
+
+    fields = get_fields()
+    limit = request.args.get("limit", current_app.config["COLLECTION_PAGE_SIZE"], type=int)
+    cursor = request.args.get("cursor", type=int)
+
+    if limit < 1:
+        abort(400, '"limit" must be at least 1.')
+
+    limit = min(limit, current_app.config["API_PAGE_SIZE"])
+
+    conditions = ["anime_collections.user_id = ?"]
+    parameters = [g.user["user_id"]]
+
+    # Continue after the last release of the previous page
+    if cursor is not None:
+        conditions.append("anime_collections.release_id > ?")
+        parameters.append(cursor)
+
+    # The cursor is needed even if the client didn't ask for it
+    columns = fields if "release_id" in fields else ["release_id", *fields]
+
+    # Get one extra row to know if there is a next page
+    rows = get_database().execute(queries.select_collection(columns, conditions, paged=True),
+                                  [*parameters, limit + 1]).fetchall()
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["release_id"]
+
+    return jsonify({"items": [to_json(row, fields) for row in rows],
+                    "next_cursor": next_cursor})
+
+
+@blueprint.route("/collection/<int:release_id>")
+@api_login_required
+def get_release(release_id):
+    """Get a release in the user's collection."""
+
+    fields = get_fields()
+
+    release = get_database().execute(queries.select_collection(fields, ["anime_collections.user_id = ?",
+                                                                        "anime_collections.release_id = ?"]),
+                                     [g.user["user_id"], release_id]).fetchone()
+
+    if release is None:
+        abort(404, f"Release {release_id} is not in your collection.")
+
+    return jsonify(to_json(release, fields))
+
+
+@blueprint.route("/collection", methods=["POST"])
+@api_login_required
+def add_releases():
+    """Add releases to the user's collection, all in one transaction, along
+    with any of their editable fields. Releases already in the collection are
+    left as they are.
+    """
+
+    items = get_items()
+    release_ids = get_release_ids(items)
+    values = [parse_values(item) for item in items]
+
+    database = get_database()
+
+    # Look up the anime of every release at once
+    anime_ids = dict(database.execute(queries.select_anime_ids(len(release_ids)),
+                                      release_ids).fetchall()) if release_ids else {}
+
+    missing = [release_id for release_id in release_ids if release_id not in anime_ids]
+
+    if missing:
+        abort(404, f"No releases with ids {', '.join(map(str, missing))}.")
+
+    user_id = g.user["user_id"]
+
+    with database:
+        existing = get_existing(database, user_id, release_ids)
+
+        database.executemany("INSERT INTO anime_collections "
+                             "(user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment) "
+                             "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT (user_id, release_id) DO NOTHING",
+                             [[user_id, anime_ids[release_id], release_id,
+                               *[item_values.get(field) for field in EDITABLE_FIELDS]]
+                              for release_id, item_values in zip(release_ids, values)])
+
+    added = [release_id for release_id in dict.fromkeys(release_ids) if release_id not in existing]
+
+    if added:
+        bump_collection_version(user_id)
+
+    return jsonify({"added": added, "existing": sorted(existing)})
+
+
+@blueprint.route("/collection", methods=["PATCH"])
+@api_login_required
+def update_releases():
+    """Change the editable fields given for each release in the user's
+    collection, all in one transaction. Fields that aren't given are kept.
+    """
+
+    items = get_items()
+    release_ids = get_release_ids(items)
+    values = [parse_values(item) for item in items]
+
+    database = get_database()
+    user_id = g.user["user_id"]
+
+    with database:
+        existing = get_existing(database, user_id, release_ids)
+
+        # Releases changing the same fields are updated with one statement
+        updates = {}
+
+        for release_id, item_values in zip(release_ids, values):
+            if release_id in existing and item_values:
+                updates.setdefault(tuple(item_values), []).append([*item_values.values(), user_id, release_id])
+
+        for fields, parameters in updates.items():
+            database.executemany(queries.update_collection_fields(fields), parameters)
+
+    updated = [release_id for release_id in dict.fromkeys(release_ids) if release_id in existing]
+    missing = [release_id for release_id in dict.fromkeys(release_ids) if release_id not in existing]
+
+    if updated:
+        bump_collection_version(user_id)
+
+    return jsonify({"updated": updated, "missing": missing})
+
+
+@blueprint.route("/collection", methods=["DELETE"])
+@api_login_required
+def remove_releases():
+    """Remove releases from the user's collection, all in one transaction."""
+
+    release_ids = get_release_ids(get_items())
+
+    database = get_database()
+    user_id = g.user["user_id"]
+
+    with database:
+        removed = database.executemany(queries.DELETE_COLLECTION_RELEASE,
+                                       [[user_id, release_id] for release_id in release_ids]).rowcount
+
+    if removed:
+        bump_collection_version(user_id)
+
+    return jsonify({"removed": removed})
+
+
+@blueprint.cli.command("create-api-token")
+@click.argument("username")
+def create_api_token_command(username):
+    """Create an API token for a user and print it."""
+
+    click.echo(create_token(get_database(), get_user_id(username)))
@@ -1,33 +1,100 @@
 # Authentication blueprint and views set up taken directly from:
 # https://flask.palletsprojects.com/en/3.0.x/tutorial/views/
 
+from collections import OrderedDict
 import functools
+import threading
+import time
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request, session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from mac import queries
+from mac.cache import database_generation
 from mac.db import get_database
+from mac.passwords import check_password, hash_password, needs_rehash
 
 # Create "auth" blueprint for user authentication
 blueprint = Blueprint("auth", __name__, url_prefix="/auth")
 
+# Only one thread at a time should change the cache of logged in users
+users_lock = threading.Lock()
+
+
+def get_user_cache():
+    """Return the application's cache of recently loaded users by database
+    generation and id, each with the time it stops being valid, ordered from
+    least to most recently used.
+    """
+
+    return current_app.extensions.setdefault("user_cache", OrderedDict())
+
 
 @blueprint.before_app_request
 def load_logged_in_user():
     """If user's id is stored in session, load user object from database
-    into ``g.user``."""
+    into ``g.user``. Users are cached for a short time, so that most requests
+    don't need to query the database for them.
+    """
+
+    # Views that never use the logged in user don't need it loaded
+    view = current_app.view_functions.get(request.endpoint)
+
+    if request.endpoint == "static" or getattr(view, "user_not_needed", False):
+        return
 
     user_id = session.get("user_id")
 
     if user_id is None:
         g.user = None
-    else:
-        g.user = get_database().execute(
-            "SELECT * FROM users WHERE user_id = ?",
-            [user_id]
-        ).fetchone()
+        return
+
+    users = get_user_cache()
+
+    # Users loaded before the database was initialized again are different users
+    key = (database_generation(), user_id)
+
+    with users_lock:
+        cached = users.get(key)
+
+        if cached is not None and cached[0] > time.monotonic():
+            users.move_to_end(key)
+            g.user = cached[1]
+            return
+
+    # Only load the columns views need, leaving out the password hash
+    user = get_database().execute(queries.SELECT_LOGGED_IN_USER, [user_id]).fetchone()
+
+    g.user = None if user is None else dict(user)
+
+    if g.user is not None:
+        with users_lock:
+            users[key] = (time.monotonic() + current_app.config["USER_CACHE_TTL"], g.user)
+            users.move_to_end(key)
+
+            # Forget the least recently used users once the cache is full
+            while len(users) > current_app.config["USER_CACHE_SIZE"]:
+                users.popitem(last=False)
+
+
+def forget_user(user_id):
+    """Remove a user from the cache, so that the next request loads them again.
+    Must be called whenever a user's data changes, such as their password.
+    """
+
+    with users_lock:
+        get_user_cache().pop((database_generation(), user_id), None)
+
+
+def user_not_needed(view):
+    """View decorator marking views that never use ``g.user``, so that the
+    logged in user is not loaded for them.
+    """
+
+    view.user_not_needed = True
+
+    return view
 
 
 def login_required(view):
@@ -80,7 +147,7 @@ def register():
             try:
                 database.execute(
                     "INSERT INTO users (username, password) VALUES (?, ?)",
-                    [username, generate_password_hash(password)]
+                    [username, hash_password(password)]
                 )
                 database.commit()
             except database.IntegrityError:
@@ -112,15 +179,17 @@ def login():
         error = None
 
         # Get user data from the database, based on submitted username
-        user = database.execute("SELECT *"
-                                " FROM users"
-                                " WHERE username = ?",
-                                [username]).fetchone()
+        user = database.execute(queries.SELECT_USER_BY_USERNAME, [username]).fetchone()
 
         # Check that username exists and password is correct
-        if user is None or not check_password_hash(user["password"], password):
+        if user is None or not check_password(user["password"], password):
             error = "Username or password is incorrect."
 
+        # Hash the password again if the hash settings have changed since it was stored
+        elif needs_rehash(user["password"]):
+            database.execute(queries.UPDATE_USER_PASSWORD, [hash_password(password), user["user_id"]])
+            database.commit()
+
         # Create new user session on successful login and return to index page
         if error is None:
             session.clear()
@@ -138,5 +207,6 @@ def login():
 def logout():
     """Log user out by removing their id from session."""
 
+    forget_user(session.get("user_id"))
     session.clear()
     return redirect(url_for("index"))
@@ -0,0 +1,371 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import click
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from mac import titles
+from mac.collection import store_releases
+from mac.db import create_search_index, insert_batch, migrate
+
+# Words the titles of generated anime are made of
+WORDS = ["Attack", "Blade", "Bebop", "Clannad", "Dragon", "Eden", "Fullmetal", "Ghost", "Hunter", "Island",
+         "Journey", "Knight", "Legend", "Moon", "Night", "Ocean", "Phantom", "Quest", "Rose", "Samurai",
+         "Titan", "Universe", "Valkyrie", "Wolf", "Xenon", "Youth", "Zero", "Academy", "Chronicle", "Saga"]
+
+# Parts of the titles of generated releases, so that they have every kind of
+# disc type and edition
+DISC_TYPES = ["Blu-ray", "DVD", "Blu-ray + DVD", "4K UHD", "Digital"]
+EDITIONS = ["", " Limited Edition", " [Collector's Edition]", " Steelbook Edition", " Complete Series"]
+STORES = ["RightStuf", "Amazon", "Crunchyroll Store", "eBay", "Best Buy", None]
+
+# Password of every generated user
+PASSWORD = "password"
+
+# Endpoints that can be benchmarked
+ENDPOINTS = ["index", "search", "details", "add"]
+
+
+def show_title(anime_id):
+    """Return the title of a generated anime."""
+
+    rng = random.Random(anime_id)
+
+    return f"{rng.choice(WORDS)} {rng.choice(WORDS)} {anime_id}"
+
+
+def generate_releases(anime_id, count):
+    """Return ``count`` generated releases of an anime, in the form
+    collection.parse_releases() returns them.
+    """
+
+    releases = []
+
+    for number in range(count):
+        release_id = anime_id * count + number
+        release_title = (f"{show_title(anime_id)} Part {number + 1}"
+                         f"{EDITIONS[(anime_id + number) % len(EDITIONS)]} "
+                         f"({DISC_TYPES[(anime_id * 7 + number) % len(DISC_TYPES)]})")
+        type, edition = titles.parse_title(release_title)
+
+        releases.append({"anime_id": anime_id,
+                         "edition": edition,
+                         "image": None,
+                         "link": f"/encyclopedia/releases.php?id={release_id}",
+                         "release_date": f"20{10 + number % 15:02d}-{1 + number % 12:02d}-01",
+                         "release_id": release_id,
+                         "release_title": release_title,
+                         "type": type})
+
+    return releases
+
+
+def generate_dataset(path, shows, releases, users, items, unfetched=0.1, seed=0, report=None):
+    """Create a database at ``path`` holding ``shows`` anime with ``releases``
+    releases each, and ``users`` users with ``items`` releases in each of their
+    collections. A share of the anime, given by ``unfetched``, has no stored
+    releases yet, so that viewing them calls ANN.
+    """
+
+    rng = random.Random(seed)
+    report = report or (lambda message: None)
+    batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+
+    database = sqlite3.connect(path)
+    database.row_factory = sqlite3.Row
+
+    with current_app.open_resource("schema.sql") as file:
+        database.executescript(file.read().decode("utf8"))
+
+    migrate(database)
+    database.execute("PRAGMA journal_mode = WAL")
+    database.execute("PRAGMA synchronous = OFF")
+
+    # Anime, which have the same titles and types whichever seed is used
+    for start in range(1, shows + 1, batch_size):
+        insert_batch(database, [(anime_id, show_title(anime_id), ["TV", "OAV", "movie"][anime_id % 3],
+                                 f"{show_title(anime_id)} (TV)")
+                                for anime_id in range(start, min(start + batch_size, shows + 1))])
+
+    report(f"Generated {shows} anime.")
+
+    # Releases of the anime that have been fetched already
+    fetched = [anime_id for anime_id in range(1, shows + 1) if rng.random() >= unfetched]
+
+    for start in range(0, len(fetched), max(batch_size // max(releases, 1), 1)):
+        batch = fetched[start:start + max(batch_size // max(releases, 1), 1)]
+        store_releases(database, batch, [release for anime_id in batch
+                                         for release in generate_releases(anime_id, releases)])
+
+    report(f"Generated {len(fetched) * releases} releases of {len(fetched)} anime.")
+
+    # Every user has the same password, hashed once
+    password_hash = generate_password_hash(PASSWORD, current_app.config["PASSWORD_HASH_METHOD"])
+
+    with database:
+        database.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                             [(f"user{number}", password_hash) for number in range(1, users + 1)])
+
+    # Collections, made of releases of fetched anime picked at random
+    collected = 0
+
+    for user_id in range(1, users + 1):
+        picked = set()
+
+        while len(picked) < min(items, len(fetched) * releases):
+            anime_id = rng.choice(fetched)
+            picked.add((anime_id, anime_id * releases + rng.randrange(releases)))
+
+        with database:
+            database.executemany("INSERT INTO anime_collections "
+                                 "(user_id, anime_id, release_id, price_bought, date_bought, store_bought) "
+                                 "VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(user_id, anime_id, release_id,
+                                   rng.choice([None, rng.randint(5, 200)]),
+                                   rng.choice([None, f"{rng.randint(2010, 2024)}-{rng.randint(1, 12):02d}-"
+                                                     f"{rng.randint(1, 28):02d}"]),
+                                   rng.choice(STORES))
+                                  for anime_id, release_id in picked])
+
+        collected += len(picked)
+
+    report(f"Generated {users} users with {collected} releases in their collections.")
+
+    create_search_index(database)
+    database.execute("PRAGMA synchronous = FULL")
+    database.close()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers requests for anime data like the ANN API does, with generated
+    releases, so that benchmarks don't depend on ANN.
+    """
+
+    # Number of releases each anime has
+    releases = 5
+
+    def do_GET(self):
+        ids = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query).get("anime", [""])[0].split("/")
+        body = ["<ann>"]
+
+        for anime_id in ids:
+            if not anime_id.isdigit():
+                continue
+
+            body.append(f'<anime id="{anime_id}" type="TV" name="{show_title(int(anime_id))}">')
+
+            for release in generate_releases(int(anime_id), self.releases):
+                body.append(f'<release date="{release["release_date"]}" href="{release["link"]}">'
+                            f'{release["release_title"]}</release>')
+
+            body.append("</anime>")
+
+        body.append("</ann>")
+        body = "".join(body).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Don't print a line for every request
+        pass
+
+
+def start_stub_ann(releases):
+    """Start a stub ANN API in a background thread, and return the server and
+    the URL the API is at.
+    """
+
+    handler = type("Handler", (StubHandler,), {"releases": releases, "protocol_version": "HTTP/1.1"})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/encyclopedia/api.xml"
+
+
+def percentile(timings, percent):
+    """Return the ``percent`` percentile of sorted ``timings``, by nearest rank."""
+
+    return timings[min(len(timings) - 1, max(0, round(percent / 100 * len(timings)) - 1))]
+
+
+def run_benchmark(app, endpoint, concurrency, requests, seed=0):
+    """Send ``requests`` requests to an endpoint from ``concurrency`` threads
+    at once, each logged in as a different generated user. Returns the
+    latency percentiles in milliseconds, and the requests served per second.
+    """
+
+    with app.app_context():
+        database = sqlite3.connect(app.config["DATABASE"])
+        users = database.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        shows = database.execute("SELECT MAX(anime_id) FROM anime_shows").fetchone()[0]
+        releases = database.execute("SELECT release_id, anime_id FROM anime_releases").fetchall()
+        database.close()
+
+    def make_request(client, rng):
+        if endpoint == "index":
+            sort = rng.choice(["title", "date", "price"])
+            return client.get(f"/?sort={sort}&order={rng.choice(['asc', 'desc'])}")
+        if endpoint == "search":
+            return client.post("/search", data={"title": rng.choice(WORDS)[:rng.randint(3, 6)]})
+        if endpoint == "details":
+            return client.get(f"/{rng.randint(1, shows)}/details")
+        if endpoint == "add":
+            release_id, anime_id = rng.choice(releases)
+            return client.get(f"/add?release_id={release_id}&anime_id={anime_id}")
+
+    def work(worker):
+        rng = random.Random(seed * 1000 + worker)
+        client = app.test_client()
+        client.post("/auth/login", data={"username": f"user{worker % users + 1}", "password": PASSWORD})
+
+        timings = []
+        errors = 0
+
+        # Split the requests evenly between the threads
+        for _ in range(requests // concurrency + (worker < requests % concurrency)):
+            start = time.perf_counter()
+            response = make_request(client, rng)
+            timings.append(time.perf_counter() - start)
+
+            if response.status_code >= 400:
+                errors += 1
+
+        return timings, errors
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(work, range(concurrency)))
+
+    elapsed = time.perf_counter() - start
+    timings = sorted(timing * 1000 for result in results for timing in result[0])
+
+    return {"requests": len(timings),
+            "errors": sum(result[1] for result in results),
+            "p50": percentile(timings, 50),
+            "p95": percentile(timings, 95),
+            "p99": percentile(timings, 99),
+            "throughput": len(timings) / elapsed}
+
+
+@click.command("generate-dataset")
+@click.argument("path", type=click.Path(dir_okay=False))
+@click.option("--shows", default=10000, help="Number of anime.")
+@click.option("--releases", default=5, help="Number of releases of each anime.")
+@click.option("--users", default=100, help="Number of users, named user1, user2, and so on.")
+@click.option("--items", default=1000, help="Number of releases in each user's collection.")
+@click.option("--unfetched", default=0.1, help="Share of anime whose releases aren't stored yet.")
+@click.option("--seed", default=0, help="Seed of the random choices, so that datasets can be generated again.")
+def generate_dataset_command(path, shows, releases, users, items, unfetched, seed):
+    """Create a database at PATH filled with generated anime, releases, users
+    and collections, for benchmarking. Every user's password is "password".
+    """
+
+    if os.path.exists(path):
+        raise click.ClickException(f"{path} already exists.")
+
+    generate_dataset(path, shows, releases, users, items, unfetched, seed, click.echo)
+
+
+@click.command("benchmark")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--endpoint", "endpoints", multiple=True, type=click.Choice(ENDPOINTS),
+              help="Endpoint to benchmark. Can be given more than once. Defaults to all of them.")
+@click.option("--concurrency", "concurrencies", multiple=True, type=int,
+              help="Number of requests sent at once. Can be given more than once. Defaults to 1 and 8.")
+@click.option("--requests", default=200, help="Number of requests sent to each endpoint at each concurrency.")
+@click.option("--releases", default=5, help="Number of releases of each anime served by the stub ANN API.")
+@click.option("--baseline", type=click.Path(exists=True, dir_okay=False),
+              help="Results of an earlier run to compare against.")
+@click.option("--save", type=click.Path(dir_okay=False), help="File to save the results to, as a baseline.")
+@click.option("--tolerance", default=0.1, help="Slowdown from the baseline allowed before failing.")
+@click.option("--page-cache", type=click.Choice(["none", "memory", "filesystem"]), default="none",
+              help="Page cache to serve pages from. Defaults to none, so that pages are rendered every time.")
+def benchmark_command(path, endpoints, concurrencies, requests, releases, baseline, save, tolerance, page_cache):
+    """Benchmark the app against the database at PATH, made by "flask
+    generate-dataset", with a stub ANN API. Exits with an error if any
+    endpoint got slower than the baseline.
+    """
+
+    # Import here, as the app factory imports this module
+    from mac import create_app
+
+    # Run on a copy of the dataset, as adding releases and viewing anime change it,
+    # so that every run starts from the same data
+    directory = tempfile.TemporaryDirectory()
+    copy = os.path.join(directory.name, "benchmark.sqlite")
+
+    with sqlite3.connect(path) as source, sqlite3.connect(copy) as destination:
+        source.backup(destination)
+
+    server, url = start_stub_ann(releases)
+
+    # Keep the files the app writes, such as cached pages and thumbnails, out of
+    # the live instance folder, so that they neither touch it nor carry over between runs
+    app = create_app({**current_app.config, "DATABASE": copy, "ANN_API_URL": url,
+                      "PAGE_CACHE": None if page_cache == "none" else page_cache},
+                     instance_path=os.path.join(directory.name, "instance"))
+
+    results = {}
+
+    click.echo(f"{'endpoint':<10} {'threads':>7} {'requests':>8} {'errors':>6} "
+               f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8}")
+
+    for endpoint in endpoints or ENDPOINTS:
+        for concurrency in concurrencies or [1, 8]:
+            result = results[f"{endpoint}@{concurrency}"] = run_benchmark(app, endpoint, concurrency, requests)
+
+            click.echo(f"{endpoint:<10} {concurrency:>7} {result['requests']:>8} {result['errors']:>6} "
+                       f"{result['p50']:>8.2f} {result['p95']:>8.2f} {result['p99']:>8.2f} "
+                       f"{result['throughput']:>8.1f}")
+
+    server.shutdown()
+    directory.cleanup()
+
+    if save:
+        with open(save, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if not baseline:
+        return
+
+    with open(baseline) as file:
+        baseline = json.load(file)
+
+    regressions = 0
+
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+
+        # Compare tail latency, which is what users notice, and throughput
+        slowdown = result["p95"] / baseline[key]["p95"] - 1 if baseline[key]["p95"] else 0
+        fewer = 1 - result["throughput"] / baseline[key]["throughput"] if baseline[key]["throughput"] else 0
+        regressed = slowdown > tolerance or fewer > tolerance
+        regressions += regressed
+
+        click.echo(f"{key:<18} p95 {slowdown:+.0%}, throughput {-fewer:+.0%}"
+                   f"{'  REGRESSION' if regressed else ''}")
+
+    if regressions:
+        raise click.ClickException(f"{regressions} benchmarks got slower than the baseline.")
+
+
+def initialize_app(app):
+    """Register the dataset generator and benchmark commands with the application instance."""
+
+    app.cli.add_command(generate_dataset_command)
+    app.cli.add_command(benchmark_command)
@@ -0,0 +1,434 @@
+import csv
+import datetime
+import difflib
+import io
+import json
+import re
+
+import click
+from flask import (
+    Blueprint, Response, current_app, g, jsonify, request, stream_with_context
+)
+from werkzeug.exceptions import abort
+
+from mac import queries
+from mac.auth import login_required
+from mac.cache import bump_collection_version
+from mac.collection import parse_date as parse_iso_date
+from mac.db import get_database
+
+# Create "bulk" blueprint, whose commands are called directly as "flask <command>"
+blueprint = Blueprint("bulk", __name__, url_prefix="/collection", cli_group=None)
+
+# Columns of an exported collection, which are also the columns an import reads
+FIELDS = ["release_id", "release_title", "price_bought", "date_bought", "store_bought", "comment"]
+
+# Characters of an imported JSON file read at a time
+JSON_CHUNK_SIZE = 64 * 1024
+
+
+class ReadError(Exception):
+    """Raised when an imported file can't be read any further. Rows read
+    before that are still imported, and counted in ``imported`` and ``errors``.
+    """
+
+    def __init__(self, message, imported=0, errors=()):
+        super().__init__(message)
+        self.imported = imported
+        self.errors = list(errors)
+
+
+def match_release(database, row):
+    """Find the release a row of an imported collection refers to, by its
+    release_id if it has one, or otherwise by the closest release title.
+    Returns the release's row, or None if nothing matches.
+    """
+
+    release_id = (row.get("release_id") or "").strip()
+
+    if release_id:
+        if not release_id.isdigit():
+            return None
+
+        return database.execute(queries.SELECT_RELEASE_BY_ID, [int(release_id)]).fetchone()
+
+    title = (row.get("release_title") or "").strip()
+
+    if not title:
+        return None
+
+    release = database.execute(queries.SELECT_RELEASE_BY_TITLE, [title]).fetchone()
+
+    if release is not None:
+        return release
+
+    candidates = find_candidates(database, title)
+
+    matches = difflib.get_close_matches(title.lower(), [candidate["release_title"].lower() for candidate in candidates],
+                                        n=1, cutoff=0.8)
+
+    if not matches:
+        return None
+
+    return next(candidate for candidate in candidates if candidate["release_title"].lower() == matches[0])
+
+
+def find_candidates(database, title):
+    """Return releases whose titles contain every word of ``title``, or all but
+    one of them, to compare it against. Missing one word lets a title with a
+    typo in it still be found.
+    """
+
+    limit = current_app.config["IMPORT_MATCH_CANDIDATES"]
+
+    # The trigram index can only match words of at least three characters
+    words = ['"' + word.replace('"', '""') + '"' for word in re.findall(r"\w+", title) if len(word) >= 3]
+
+    if len(words) > 1:
+        query = " OR ".join("(" + " AND ".join(words[:skipped] + words[skipped + 1:]) + ")"
+                            for skipped in range(len(words)))
+    else:
+        query = "".join(words)
+
+    if query:
+        try:
+            return database.execute(queries.SELECT_RELEASE_CANDIDATES, [query, limit]).fetchall()
+        # Fall back to a LIKE search if SQLite was built without FTS5
+        except database.OperationalError:
+            pass
+
+    # Only compare against releases sharing the title's longest word
+    word = max(title.split(), key=len)
+
+    return database.execute(queries.SELECT_RELEASE_CANDIDATES_WITHOUT_INDEX, ["%" + word + "%", limit]).fetchall()
+
+
+def parse_price(price):
+    """Return a price as it is stored, or None if it is missing.
+    Raises ValueError with a message for the user if it is not a number.
+    """
+
+    price_bought = (price or "").strip().lstrip("$") or None
+
+    # Prices are stored as given, like prices entered on the edit page
+    if price_bought is not None:
+        try:
+            float(price_bought)
+        except ValueError:
+            raise ValueError(f"Price {price!r} is not a number.")
+
+    return price_bought
+
+
+def parse_date(date):
+    """Return a date as it is stored (yyyy-mm-dd), or None if it is missing.
+    Accepts dates as exported (yyyy-mm-dd) or as mm/dd/yyyy. Raises ValueError
+    with a message for the user if it is not a date.
+    """
+
+    date_bought = (date or "").strip() or None
+
+    if date_bought is not None:
+        try:
+            # Spreadsheets often write dates as mm/dd/yyyy
+            if "/" in date_bought:
+                date_bought = datetime.datetime.strptime(date_bought, "%m/%d/%Y").date().isoformat()
+            else:
+                date_bought = parse_iso_date(date_bought)
+        except ValueError:
+            raise ValueError(f"Date {date!r} is not a date.")
+
+    return date_bought
+
+
+def parse_row(database, row):
+    """Turn a row of an imported collection into the values stored for it.
+    Raises ValueError with a message for the user if the row is invalid.
+    """
+
+    release = match_release(database, row)
+
+    if release is None:
+        raise ValueError(f"No release matches {row.get('release_id') or row.get('release_title')!r}.")
+
+    price_bought = parse_price(row.get("price_bought"))
+    date_bought = parse_date(row.get("date_bought"))
+
+    return [release["anime_id"], release["release_id"], price_bought, date_bought,
+            row.get("store_bought") or None, row.get("comment") or None]
+
+
+def import_rows(database, user_id, rows):
+    """Add or update each row of an imported collection in the user's collection,
+    writing them in batched transactions. Returns how many rows were imported,
+    and a list of the rows that couldn't be, with why. Raises ReadError if the
+    file turns out to be unreadable partway through.
+    """
+
+    batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+    imported = 0
+    errors = []
+    batch = []
+
+    def store(batch):
+        with database:
+            database.executemany("INSERT INTO anime_collections "
+                                 "(user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                                 "ON CONFLICT (user_id, release_id) DO UPDATE "
+                                 "SET price_bought = excluded.price_bought, date_bought = excluded.date_bought, "
+                                 "store_bought = excluded.store_bought, comment = excluded.comment",
+                                 [[user_id, *values] for values in batch])
+
+        return len(batch)
+
+    read_error = None
+
+    try:
+        try:
+            # Rows are numbered as they appear in the file, after the header
+            for number, row in enumerate(rows, start=1):
+                try:
+                    batch.append(parse_row(database, row))
+                except ValueError as error:
+                    errors.append({"row": number, "error": str(error)})
+                    continue
+
+                if len(batch) >= batch_size:
+                    imported += store(batch)
+                    batch.clear()
+        # Keep the rows read before the file became unreadable
+        except (csv.Error, json.JSONDecodeError, UnicodeDecodeError, ReadError) as error:
+            read_error = error
+
+        if batch:
+            imported += store(batch)
+    finally:
+        # Batches already written change the collection, even if a later one failed
+        if imported:
+            bump_collection_version(user_id)
+
+    if read_error is not None:
+        raise ReadError(f"Could not read file: {read_error}", imported, errors) from read_error
+
+    return imported, errors
+
+
+def iterate_json(file):
+    """Yield each item of the JSON array in ``file``, reading the file a chunk
+    at a time, so that only the items being read are held in memory.
+    Raises json.JSONDecodeError if the file is not a JSON array.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    finished = False
+    read_more = True
+    # What comes next: the array's "[", its first item or "]", an item, or the "," or "]" after one
+    expected = "["
+
+    while True:
+        # Drop what has been read already, and read the next chunk
+        if read_more:
+            if finished:
+                raise json.JSONDecodeError("Unexpected end of file", buffer, len(buffer))
+
+            chunk = file.read(JSON_CHUNK_SIZE)
+            finished = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            read_more = False
+
+        # Skip whitespace around items
+        while position < len(buffer) and buffer[position].isspace():
+            position += 1
+
+        if position == len(buffer):
+            read_more = True
+            continue
+
+        character = buffer[position]
+
+        if expected == "[":
+            if character != "[":
+                raise json.JSONDecodeError("Expecting '['", buffer, position)
+
+            position += 1
+            expected = "first"
+        elif expected == "next":
+            if character == "]":
+                return
+            if character != ",":
+                raise json.JSONDecodeError("Expecting ',' or ']'", buffer, position)
+
+            position += 1
+            expected = "item"
+        elif expected == "first" and character == "]":
+            return
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The item may only be cut off by the end of the chunk
+                if finished:
+                    raise
+
+                read_more = True
+                continue
+
+            # An item running up to the end of the chunk, like a number, may go on in the next one
+            if end == len(buffer) and not finished:
+                read_more = True
+                continue
+
+            yield item
+            position = end
+            expected = "next"
+
+
+def read_rows(file, format):
+    """Yield each row of an imported collection as a dict. Files are read one
+    row at a time.
+    """
+
+    if format == "csv":
+        yield from csv.DictReader(file)
+    elif format == "json":
+        for number, row in enumerate(iterate_json(file), start=1):
+            if not isinstance(row, dict):
+                raise ReadError(f"Row {number} is not an object.")
+
+            # Values may be numbers in JSON, but are read as text like in CSV
+            yield {key: None if value is None else str(value) for key, value in row.items()}
+    else:
+        raise ValueError(f"Unknown format {format!r}.")
+
+
+def export_rows(database, user_id):
+    """Yield each release in the user's collection, reading them from the
+    database as they are needed.
+    """
+
+    for row in database.execute(queries.SELECT_EXPORTED_COLLECTION, [user_id]):
+        yield dict(row)
+
+
+def write_rows(rows, format):
+    """Yield an exported collection in chunks of CSV or JSON text."""
+
+    if format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, FIELDS)
+        writer.writeheader()
+
+        for row in rows:
+            writer.writerow(row)
+
+            # Hand over what has been written so far, and start over
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+        yield buffer.getvalue()
+    elif format == "json":
+        yield "["
+
+        for number, row in enumerate(rows):
+            yield ("," if number else "") + json.dumps(row)
+
+        yield "]"
+    else:
+        raise ValueError(f"Unknown format {format!r}.")
+
+
+@blueprint.route("/export.<format>")
+@login_required
+def export(format):
+    """Download the user's collection as a CSV or JSON file."""
+
+    if format not in ("csv", "json"):
+        abort(404)
+
+    rows = export_rows(get_database(), g.user["user_id"])
+
+    return Response(stream_with_context(write_rows(rows, format)),
+                    mimetype="text/csv" if format == "csv" else "application/json",
+                    headers={"Content-Disposition": f"attachment; filename=collection.{format}"})
+
+
+@blueprint.route("/import", methods=["POST"])
+@login_required
+def import_collection():
+    """Add releases to the user's collection from an uploaded CSV or JSON file,
+    and report which rows couldn't be imported.
+    """
+
+    file = request.files.get("file")
+
+    if file is None:
+        abort(400)
+
+    # Use the format given, or otherwise the file's extension
+    format = request.form.get("format") or file.filename.rsplit(".", 1)[-1].lower()
+
+    if format not in ("csv", "json"):
+        abort(400)
+
+    rows = read_rows(io.TextIOWrapper(file.stream, encoding="utf-8-sig"), format)
+
+    try:
+        imported, errors = import_rows(get_database(), g.user["user_id"], rows)
+    except ReadError as error:
+        return jsonify({"error": str(error), "imported": error.imported, "errors": error.errors}), 400
+
+    return jsonify({"imported": imported, "errors": errors})
+
+
+def get_user_id(username):
+    """Return the id of the user with ``username``, for the commands below."""
+
+    user = get_database().execute("SELECT user_id FROM users WHERE username = ?", [username]).fetchone()
+
+    if user is None:
+        raise click.ClickException(f"No user is named {username}.")
+
+    return user["user_id"]
+
+
+@blueprint.cli.command("export-collection")
+@click.argument("username")
+@click.argument("output", type=click.File("w", encoding="utf-8"), default="-")
+@click.option("--format", type=click.Choice(["csv", "json"]), default="csv")
+def export_collection_command(username, output, format):
+    """Write a user's collection to OUTPUT, or the terminal, as CSV or JSON."""
+
+    for chunk in write_rows(export_rows(get_database(), get_user_id(username)), format):
+        output.write(chunk)
+
+
+@blueprint.cli.command("import-collection")
+@click.argument("username")
+@click.argument("file", type=click.File("r", encoding="utf-8-sig"))
+@click.option("--format", type=click.Choice(["csv", "json"]),
+              help="Format of FILE. Defaults to its extension.")
+def import_collection_command(username, file, format):
+    """Add releases from a CSV or JSON file to a user's collection."""
+
+    format = format or file.name.rsplit(".", 1)[-1].lower()
+
+    if format not in ("csv", "json"):
+        raise click.BadParameter("Use --format to say if FILE is CSV or JSON.")
+
+    try:
+        imported, errors = import_rows(get_database(), get_user_id(username), read_rows(file, format))
+    except ReadError as error:
+        for row_error in error.errors:
+            click.echo(f"Row {row_error['row']}: {row_error['error']}")
+
+        raise click.ClickException(f"{error} Imported {error.imported} releases before that.")
+
+    for error in errors:
+        click.echo(f"Row {error['row']}: {error['error']}")
+
+    click.echo(f"Imported {imported} releases, {len(errors)} rows could not be imported.")
@@ -0,0 +1,224 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import os
+import shutil
+import threading
+
+from flask import current_app, g, make_response, request, session
+
+
+class MemoryCache:
+    """Keeps rendered pages in this process's memory, evicting the least
+    recently used page once ``size`` pages are cached.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id, version, path):
+        with self.lock:
+            page = self.pages.get((user_id, path))
+
+            # Pages rendered before the collection last changed are out of date
+            if page is None or page[0] != version:
+                return None
+
+            self.pages.move_to_end((user_id, path))
+
+            return page[1]
+
+    def set(self, user_id, version, path, body):
+        with self.lock:
+            self.pages[(user_id, path)] = (version, body)
+            self.pages.move_to_end((user_id, path))
+
+            while len(self.pages) > self.size:
+                self.pages.popitem(last=False)
+
+    def clear(self, user_id):
+        # Pages of other versions are already ignored by get()
+        pass
+
+
+class FileSystemCache:
+    """Keeps rendered pages in files under ``directory``, which every process
+    serving the application shares.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, user_id, path):
+        return os.path.join(self.directory, str(user_id), hashlib.sha256(path.encode()).hexdigest())
+
+    def get(self, user_id, version, path):
+        try:
+            with open(self.get_path(user_id, path), encoding="utf8") as file:
+                cached_version, body = file.read().split("\n", 1)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        # Pages rendered before the collection last changed are out of date
+        if cached_version != version:
+            return None
+
+        return body
+
+    def set(self, user_id, version, path, body):
+        file_path = self.get_path(user_id, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+
+        # Write to a temporary file first, so that readers never see half a page
+        temporary = f"{file_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+        with open(temporary, "w", encoding="utf8") as file:
+            file.write(f"{version}\n{body}")
+
+        os.replace(temporary, file_path)
+
+    def clear(self, user_id):
+        shutil.rmtree(os.path.join(self.directory, str(user_id)), ignore_errors=True)
+
+
+def get_cache():
+    """Return the application's page cache, as chosen by the PAGE_CACHE config,
+    or None if pages aren't cached.
+    """
+
+    if "page_cache" not in current_app.extensions:
+        backend = current_app.config["PAGE_CACHE"]
+
+        if backend == "memory":
+            cache = MemoryCache(current_app.config["PAGE_CACHE_SIZE"])
+        elif backend == "filesystem":
+            cache = FileSystemCache(os.path.join(current_app.instance_path, "page-cache"))
+        else:
+            cache = None
+
+        current_app.extensions["page_cache"] = cache
+
+    return current_app.extensions["page_cache"]
+
+
+def get_generation_path():
+    """Return the path of the file marking when the database was last initialized."""
+
+    return os.path.join(current_app.instance_path, "database.generation")
+
+
+def database_generation():
+    """Return a number that changes every time the database is initialized,
+    which starts user ids over, or 0 if that has never happened.
+    """
+
+    try:
+        return os.stat(get_generation_path()).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def reset_caches():
+    """Forget every cached page and collection version, and start a new
+    generation, so that processes drop what they cached in memory as well.
+    Called when the database is initialized, as new users reuse old users' ids.
+    """
+
+    shutil.rmtree(os.path.join(current_app.instance_path, "page-cache"), ignore_errors=True)
+    shutil.rmtree(os.path.join(current_app.instance_path, "collections"), ignore_errors=True)
+
+    with open(get_generation_path(), "w") as file:
+        file.write(os.urandom(8).hex())
+
+
+def get_version_path(user_id):
+    """Return the path of the file holding a user's collection version."""
+
+    return os.path.join(current_app.instance_path, "collections", f"{user_id}.version")
+
+
+def collection_version(user_id):
+    """Return the version of a user's collection, which changes every time
+    a release is added to, edited in, or removed from it, and every time the
+    database is initialized.
+    """
+
+    try:
+        with open(get_version_path(user_id)) as file:
+            version = file.read()
+    except FileNotFoundError:
+        version = "0"
+
+    return f"{database_generation()}.{version}"
+
+
+def bump_collection_version(user_id):
+    """Record that a user's collection has changed, so that pages showing it
+    are rendered again.
+    """
+
+    path = get_version_path(user_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Use a new random version, so that two processes changing the collection at once can't collide
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(temporary, "w") as file:
+        file.write(os.urandom(8).hex())
+
+    os.replace(temporary, path)
+
+    cache = get_cache()
+
+    if cache is not None:
+        cache.clear(user_id)
+
+
+def cached_collection_page(view):
+    """View decorator that caches the page rendered by the view for each user
+    until their collection changes, and answers conditional requests for a
+    page that hasn't changed without rendering it at all.
+    """
+
+    @functools.wraps(view)
+    def wrapped_view(**kwargs):
+        cache = get_cache()
+
+        # Flashed messages are shown once, so pages with them can't be cached
+        if cache is None or "_flashes" in session:
+            return view(**kwargs)
+
+        user_id = g.user["user_id"]
+        version = collection_version(user_id)
+        path = request.full_path
+
+        # Identifies this page at this version of the collection
+        etag = hashlib.sha256(f"{user_id}:{version}:{path}".encode()).hexdigest()
+
+        # The browser already has this version of the page
+        if etag in request.if_none_match:
+            response = make_response("", 304)
+        else:
+            body = cache.get(user_id, version, path)
+
+            if body is None:
+                response = make_response(view(**kwargs))
+
+                # Only cache successfully rendered pages
+                if response.status_code != 200:
+                    return response
+
+                cache.set(user_id, version, path, response.get_data(as_text=True))
+            else:
+                response = make_response(body)
+
+        response.set_etag(etag)
+        # Browsers may keep the page, but must check that it is still current
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+        return response
+
+    return wrapped_view
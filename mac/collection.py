@@ -1,73 +1,169 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
 
+from mac import queries, titles, typeahead
 from mac.auth import login_required
+from mac.cache import bump_collection_version, cached_collection_page
 from mac.db import get_database
 
-import xml.etree.ElementTree as ET
-import urllib.request
-
-import re
+from concurrent.futures import Future, ThreadPoolExecutor
+import datetime
+import threading
+import time
 
 blueprint = Blueprint("collection", __name__)
 
+# Retrievals of anime data from the ANN API that are in progress, by anime id
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+# Anime whose data is waiting to be refreshed in the background, or being refreshed
+scheduled = set()
+
+# Background threads that refresh out of date anime data, started on first use
+refresher = None
+
+# Columns the collection can be sorted by, mapped to the SQL expression used as
+# the sort key and the Python type its values are compared as
+SORT_KEYS = {
+    "title": ("anime_releases.release_title", str),
+    "date": ("COALESCE(date_bought, '')", str),
+    "price": ("CAST(COALESCE(NULLIF(price_bought, ''), 0) AS REAL)", float),
+}
+
+
+def parse_date(date):
+    """Check that a date is given as yyyy-mm-dd, and return it as it is stored.
+    Raises ValueError otherwise.
+    """
+
+    return datetime.date.fromisoformat(date).isoformat()
+
+
+def contains_pattern(text):
+    """Return a LIKE pattern matching values that contain ``text``, taking any
+    % and _ in it literally.
+    """
+
+    text = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    return f"%{text}%"
+
+
+# Filters the collection can be narrowed down by, mapped to the SQL condition
+# each adds and the function turning its query parameter into the value compared
+FILTERS = {
+    "disc_type": ("anime_releases.disc_type = ?", str),
+    "edition": ("anime_releases.edition = ?", str),
+    "store_bought": ("anime_collections.store_bought = ?", str),
+    "price_min": ("anime_collections.price_bought >= ?", float),
+    "price_max": ("anime_collections.price_bought <= ?", float),
+    "date_from": ("anime_collections.date_bought >= ?", parse_date),
+    "date_to": ("anime_collections.date_bought <= ?", parse_date),
+    "title": ("anime_releases.release_title LIKE ? ESCAPE '\\'", contains_pattern),
+}
+
+
 @blueprint.route("/")
 @login_required
+@cached_collection_page
 def index():
     """Displays the user's anime collection."""
 
     # Get connection to database
     database = get_database()
 
-    # Get list of release titles, ids, and images of shows that the user has added to their collection
-    collection = database.execute("SELECT release_title, release_id, image "
-                                  "FROM anime_releases "
-                                  "WHERE release_id in ("
-                                  "    SELECT release_id"
-                                  "    FROM anime_collections"
-                                  "    WHERE user_id = ?"
-                                  ") AND anime_id in ("
-                                  "    SELECT anime_id"
-                                  "    FROM anime_collections"
-                                  "    WHERE user_id = ?"
-                                  ") ORDER BY release_title",
-                                  [g.user["user_id"], g.user["user_id"]]).fetchall()
+    # Get query parameters for sorting and paging through the collection
+    sort = request.args.get("sort", "title")
+    order = request.args.get("order", "asc")
+    after = request.args.get("after")
+    after_id = request.args.get("after_id", type=int)
+
+    # Default to sorting by title if sort parameters are invalid
+    if sort not in SORT_KEYS:
+        sort = "title"
+    if order not in ("asc", "desc"):
+        order = "asc"
+
+    key, key_type = SORT_KEYS[sort]
+    page_size = current_app.config["COLLECTION_PAGE_SIZE"]
+
+    conditions = ["anime_collections.user_id = ?"]
+    parameters = [g.user["user_id"]]
+
+    # Only show releases matching the filters given, ignoring invalid ones
+    filters = {}
+
+    for name, (condition, convert) in FILTERS.items():
+        value = request.args.get(name, "").strip()
+
+        if not value:
+            continue
+
+        try:
+            parameters.append(convert(value))
+        except ValueError:
+            continue
+
+        conditions.append(condition)
+        filters[name] = value
+
+    # Continue from the last release shown on the previous page
+    if after is not None and after_id is not None:
+        try:
+            after = key_type(after)
+        except ValueError:
+            abort(400)
+
+        conditions.append(f"({key}, anime_releases.release_id) {'>' if order == 'asc' else '<'} (?, ?)")
+        parameters.extend([after, after_id])
+
+    # Get one page of the releases in the user's collection, along with the
+    # user's information about each release, plus one extra row to know if there is a next page
+    collection = database.execute(queries.select_collection_page(key, order, conditions),
+                                  [*parameters, page_size + 1]).fetchall()
+
+    # Link to the next page if there are more releases after this one
+    next_page = None
+
+    if len(collection) > page_size:
+        collection = collection[:page_size]
+        next_page = url_for("index", sort=sort, order=order, **filters,
+                            after=collection[-1]["sort_key"], after_id=collection[-1]["release_id"])
 
     # Create list to hold anime information about each anime in collection
     anime_collection = []
 
-    # Add anime information for each anime and add to anime_collection list
     for anime in collection:
         anime = dict(anime)
 
         # Add link to each release's ANN page
         anime["link"] = f"https://www.animenewsnetwork.com/encyclopedia/releases.php?id={anime.get('release_id')}"
 
-        # Get more information for each anime in collection from database
-        anime_information = database.execute("SELECT price_bought, date_bought, store_bought, comment "
-                                             "FROM anime_collections "
-                                             "WHERE release_id = ? AND user_id = ?",
-                                             [anime.get("release_id"), g.user["user_id"]]).fetchone()
-
-        # Add anime information to anime dict
-        anime["price_bought"] = anime_information["price_bought"]
-        anime["date_bought"] = anime_information["date_bought"]
-        anime["store_bought"] = anime_information["store_bought"]
-        anime["comment"] = anime_information["comment"]
-
         anime_collection.append(anime)
 
     # Will contain a message if user doesn't have a collection yet
     message = None
 
-    # Add message if collection is empty
-    if not collection:
-        message = ("This is where your anime collection will be displayed once "
-                   "you add some shows to your collection!")
+    # Add message if collection is empty, or nothing in it matches the filters
+    if not collection and after is None:
+        if filters:
+            message = "No releases in your collection match these filters."
+        else:
+            message = ("This is where your anime collection will be displayed once "
+                       "you add some shows to your collection!")
+
+    # Offer the disc types, editions, and stores found in the user's collection as filters
+    choices = {"disc_type": [], "edition": [], "store": []}
 
-    return render_template("collection/index.html", message=message, collection=anime_collection)
+    for row in database.execute(queries.SELECT_FILTER_CHOICES, [g.user["user_id"]]):
+        if row["value"]:
+            choices[row["dimension"]].append(row["value"])
+
+    return render_template("collection/index.html", message=message, collection=anime_collection,
+                           sort=sort, order=order, next_page=next_page, filters=filters, choices=choices)
 
 
 @blueprint.route("/search", methods=["GET", "POST"])
@@ -87,8 +183,7 @@ def search():
         error = None
 
         # Search if title is in the anime_shows table of the database
-        anime_list = database.execute("SELECT * FROM anime_shows WHERE title LIKE ?",
-                                      ["%" + title + "%"]).fetchall()
+        anime_list = search_titles(database, title)
 
         # Check that title matches any shows in database
         if not anime_list:
@@ -102,12 +197,53 @@ def search():
     return render_template("collection/search.html")
 
 
+@blueprint.route("/search/titles")
+@login_required
+def search_typeahead():
+    """Return the anime whose titles start with the text typed so far, as JSON.
+    Served from the catalog snapshot mapped into memory, so that keystrokes do
+    not query the database.
+    """
+
+    # Get query parameters
+    prefix = request.args.get("q", "").strip()
+    limit = min(request.args.get("limit", current_app.config["TYPEAHEAD_LIMIT"], type=int),
+                current_app.config["TYPEAHEAD_LIMIT"])
+
+    # Nothing has been typed yet
+    if not prefix or limit < 1:
+        return jsonify([])
+
+    return jsonify(typeahead.complete(prefix, limit))
+
+
+def search_titles(database, title):
+    """Search the anime_shows table for titles containing ``title``, with the
+    best matches first. Uses the anime_titles full-text index when available.
+    """
+
+    limit = current_app.config["SEARCH_RESULT_LIMIT"]
+
+    # The trigram index can only match search terms of at least three characters
+    if len(title) >= 3:
+        try:
+            return database.execute(queries.SEARCH_TITLES,
+                                    ['"' + title.replace('"', '""') + '"', limit]).fetchall()
+        # Fall back to a LIKE search if SQLite was built without FTS5
+        except database.OperationalError:
+            pass
+
+    return database.execute(queries.SEARCH_TITLES_WITHOUT_INDEX, ["%" + title + "%", limit]).fetchall()
+
+
 @blueprint.route("/<int:id>/details", methods=["GET", "POST"])
 @login_required
 def details(id):
     """Get more details about an anime's different releases.
     The info is first retrieved through the AnimeNewsNetwork (ANN) API, then is
-    stored in the database for any successive searches.
+    stored in the database for any successive searches. Once the stored info
+    is older than the configured TTL, it is still shown straight away, while
+    it is refreshed from the API in the background.
     """
 
     # Get connection to database
@@ -116,21 +252,42 @@ def details(id):
     # Keep track of any errors that may occur
     error = None
 
-    # Retrieve anime data from the anime_releases table
-    anime_data = database.execute("SELECT * FROM anime_releases WHERE anime_id = ?",
-                                  [id]).fetchall()
+    # Retrieve the anime's title, when its releases were last fetched, and the
+    # releases themselves. An anime with no releases still gets one row
+    anime_data = database.execute(queries.SELECT_ANIME_DETAILS, [id]).fetchall()
+
+    # The anime is not in the catalog
+    if not anime_data:
+        abort(404)
 
     # Create list to store data about the anime's different releases
     releases = []
 
     # If anime data is not in anime_releases yet, retrieve the anime's info from the ANN API
-    if not anime_data:
+    if anime_data[0]["fetched_at"] is None:
+        # The ANN client, and the XML parser it needs, are only loaded once an anime has to be fetched
+        from mac import ann
+
         # Call ANN API
-        releases = retrieve_anime_data(database, id)
+        try:
+            releases = retrieve_anime_data(database, id)
+        # Let the user know if ANN could not be reached
+        except ann.FetchError:
+            flash("Could not get this anime's releases from AnimeNewsNetwork. Please try again later.")
+
+            return render_template("collection/details.html", releases=releases)
 
     # Otherwise, use the data retrieved from the database
     else:
+        # Refresh the anime's releases in the background if they are out of date
+        if time.time() - anime_data[0]["fetched_at"] > current_app.config["RELEASES_TTL"]:
+            schedule_refresh(id)
+
         for release in anime_data:
+            # The anime was fetched before, but had no releases
+            if release["release_id"] is None:
+                continue
+
             # Convert release data from database into a dict
             release = dict(release)
 
@@ -142,10 +299,7 @@ def details(id):
 
     # Display message if a show has no releases
     if not releases:
-        title = database.execute("SELECT title FROM anime_shows WHERE anime_id = ?",
-                                 [id]).fetchone()["title"]
-
-        error = f"{title} has no releases."
+        error = f"{anime_data[0]['title']} has no releases."
 
         flash(error)
 
@@ -153,20 +307,95 @@ def details(id):
     return render_template("collection/details.html", releases=releases)
 
 
+def schedule_refresh(id):
+    """Retrieve an anime's data from the ANN API again in a background thread,
+    unless it is already being retrieved or waiting to be.
+    """
+
+    global refresher
+
+    with in_flight_lock:
+        if id in scheduled or id in in_flight:
+            return
+
+        scheduled.add(id)
+
+        # Start the background threads that refresh anime data on first use
+        if refresher is None:
+            refresher = ThreadPoolExecutor(max_workers=current_app.config["RELEASES_REFRESH_WORKERS"])
+
+    refresher.submit(refresh_anime_data, current_app._get_current_object(), id)
+
+
+def refresh_anime_data(app, id):
+    """Retrieve an anime's data from the ANN API, outside of any request.
+    Collection pages showing the anime's releases are rendered again if they changed.
+    """
+
+    from mac import ann
+
+    with app.app_context():
+        try:
+            retrieve_anime_data(get_database(), id)
+        except ann.FetchError as error:
+            app.logger.warning("Could not refresh releases of anime %s: %s", id, error)
+        finally:
+            # Let the anime be refreshed again once its data goes out of date
+            with in_flight_lock:
+                scheduled.discard(id)
+
+
 def retrieve_anime_data(database, id):
     """Use the AnimeNewsNetwork API to retrieve data about an anime
-    based on its id.
+    based on its id. If the same anime is already being retrieved by another
+    request, wait for that request's result instead of calling the API again.
     """
 
-    # Get info from the AnimeNewsNetwork API XML url
-    with urllib.request.urlopen(f"https://cdn.animenewsnetwork.com/encyclopedia/api.xml?anime={id}") as response:
-        xml = response.read()
+    with in_flight_lock:
+        retrieval = in_flight.get(id)
+        leader = retrieval is None
+
+        # This request is the first to retrieve the anime, so others will wait on it
+        if leader:
+            retrieval = in_flight[id] = Future()
+
+    if not leader:
+        return retrieval.result()
+
+    try:
+        releases = fetch_anime_data(database, id)
+    except BaseException as exception:
+        # Waiting requests fail the same way this one did
+        retrieval.set_exception(exception)
+        raise
+    else:
+        retrieval.set_result(releases)
+    finally:
+        with in_flight_lock:
+            del in_flight[id]
+
+    return releases
+
 
-    # Parse XML file obtained from the ANN API
-    root = ET.fromstring(xml)
+def fetch_anime_data(database, id):
+    """Call the AnimeNewsNetwork API for an anime's releases, and store them."""
 
-    # Get the anime element from the XML file
-    anime = root.find("anime")
+    from mac import ann
+
+    # Get the anime element from the ANN API's XML response
+    anime = ann.fetch_anime([id]).get(id)
+
+    # ANN has no data for this anime
+    releases = [] if anime is None else parse_releases(anime, id)
+
+    # Insert anime data into database to avoid having to call API each time
+    store_releases(database, [id], releases)
+
+    return releases
+
+
+def parse_releases(anime, id):
+    """Get data on all the releases in an <anime> element from the ANN API."""
 
     # Create list to store data on the anime's releases
     releases = []
@@ -177,40 +406,13 @@ def retrieve_anime_data(database, id):
         link = release.get("href")
         release_date = release.get("date")
         release_id = link[link.find("=") + 1:]
-        release_title = release.text
+        release_title = release.text or ""
 
         # Generate link to release's image from its ANN page
         image = f"https://cdn.animenewsnetwork.com/thumbnails/area200x300/releases/{release_id}.jpg"
 
-        # Release's disc type is always at the end of the release_title, inside
-        # of parentheses. This regex extracts the type from the title
-        type = re.findall("\(([^)]+)", release_title)[-1]
-
-        # Check for release being a special edition
-        if "edition" in release_title.lower():
-            # Get substring that comes before the word "edition" in the release_title
-            title = release_title.lower().split("edition")[0]
-
-            # Split first substring into different words
-            title = title.split()
-
-            # Get the last word from the list, which is that release's edition type
-            edition = title[-1]
-
-            # Remove first character of word if it's not a letter
-            if not edition[0].isalpha():
-                edition = edition[1:]
-
-            # Capitalize the word
-            edition = edition.capitalize()
-
-            # Maintain consistency in spelling of "Collector's Edition"
-            if edition == "Collectors":
-                edition = "Collector's"
-
-        # If release is not any kind of special edition, then default to "Standard"
-        else:
-            edition = "Standard"
+        # Get the release's disc type and edition from its title
+        type, edition = titles.parse_title(release_title)
 
         # Create dict of anime data
         release_info = {"anime_id": anime_id,
@@ -225,15 +427,45 @@ def retrieve_anime_data(database, id):
         # Add release to list of releases
         releases.append(release_info)
 
-        # Insert anime data into database to avoid having to call API each time
-        database.execute("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, edition, release_date, image) "
-                        "VALUES (?, ?, ?, ?, ?, ?, ?)",
-                        [release_id, anime_id, release_title, type, edition, release_date, image])
-        database.commit()
-
     return releases
 
 
+def store_releases(database, anime_ids, releases):
+    """Insert releases parsed from the ANN API into the anime_releases table,
+    and record that the anime in ``anime_ids`` were fetched, in one transaction.
+    Users with changed releases in their collection get their pages rendered again.
+    """
+
+    collectors = []
+
+    with database:
+        database.executemany("INSERT OR REPLACE INTO release_fetches (anime_id, fetched_at) "
+                             "VALUES (?, CAST(strftime('%s', 'now') AS INTEGER))",
+                             [[anime_id] for anime_id in anime_ids])
+        # Releases that were already stored, for example by another process,
+        # are only written again if their data has changed
+        changed = database.executemany("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, edition, release_date, image) "
+                                       "VALUES (:release_id, :anime_id, :release_title, :type, :edition, :release_date, :image) "
+                                       "ON CONFLICT (release_id, anime_id) DO UPDATE "
+                                       "SET release_title = excluded.release_title, disc_type = excluded.disc_type, "
+                                       "edition = excluded.edition, release_date = excluded.release_date, image = excluded.image "
+                                       "WHERE release_title IS NOT excluded.release_title "
+                                       "OR disc_type IS NOT excluded.disc_type "
+                                       "OR edition IS NOT excluded.edition "
+                                       "OR release_date IS NOT excluded.release_date "
+                                       "OR image IS NOT excluded.image",
+                                       releases).rowcount
+
+        # Find who has releases of these anime in their collection, if any of them changed
+        if changed and anime_ids:
+            collectors = [row[0] for row in database.execute(queries.select_collectors(len(anime_ids)), anime_ids)]
+
+    # Only once the new releases are committed, so that pages rendered for the
+    # new versions show them
+    for user_id in collectors:
+        bump_collection_version(user_id)
+
+
 @blueprint.route("/add")
 @login_required
 def add():
@@ -257,14 +489,20 @@ def add():
         database.commit()
     # Display error if release has already been added to user's collection
     except database.IntegrityError:
-        anime = database.execute("SELECT release_title FROM anime_releases WHERE release_id = ?",
-                                 [release_id]).fetchone()["release_title"]
-        error = f"{anime} is already in your collection."
+        anime = database.execute(queries.SELECT_RELEASE_TITLE, [release_id]).fetchone()
+
+        # The release does not exist, rather than already being in the collection
+        if anime is None:
+            abort(404)
+
+        error = f"{anime['release_title']} is already in your collection."
 
         flash(error)
 
         return redirect(url_for("collection.details", id=anime_id))
 
+    bump_collection_version(g.user["user_id"])
+
     # Redirect to homepage to show user's anime collection
     return redirect(url_for("collection.edit", release_id=release_id))
 
@@ -286,34 +524,39 @@ def edit(release_id):
         store_bought = request.form.get("stores")
         comment = request.form.get("comment")
 
-        # Format date into mm/dd/yyyy format
-        date_bought = format_date(date_bought)
+        # Keep track of any errors that may occur
+        error = None
 
-        # Insert user submitted information for anime collection into database
-        database.execute("UPDATE anime_collections "
-                         "SET price_bought = ?, date_bought = ?, store_bought = ?, comment = ? "
-                         "WHERE user_id = ? AND release_id = ?",
-                         [price_bought, date_bought, store_bought, comment, g.user["user_id"], release_id])
-        database.commit()
+        # Dates are submitted and stored as yyyy-mm-dd, which the filters and stats
+        # compare them as. Store missing values as NULL
+        try:
+            date_bought = parse_date(date_bought) if date_bought else None
+        except ValueError:
+            error = f"{date_bought} is not a date."
 
-        return redirect(url_for("index"))
+        price_bought = price_bought or None
 
-    # Keep track of any errors that may occur
-    error = None
+        if error is None:
+            # Insert user submitted information for anime collection into database
+            database.execute(queries.UPDATE_COLLECTION_RELEASE,
+                             [price_bought, date_bought, store_bought, comment, g.user["user_id"], release_id])
+            database.commit()
+
+            bump_collection_version(g.user["user_id"])
+
+            return redirect(url_for("index"))
+
+        flash(error)
 
     # Create dict to store information about anime release
     release = {}
 
     # Get information about anime in collection from database
-    release["release_title"] = database.execute("SELECT release_title "
-                                                "FROM anime_releases "
-                                                "WHERE release_id = ?",
+    release["release_title"] = database.execute(queries.SELECT_RELEASE_TITLE,
                                                 [release_id]).fetchone()["release_title"]
 
-    release_info = database.execute("SELECT price_bought, date_bought, store_bought, comment "
-                                    "FROM anime_collections "
-                                    "WHERE release_id = ?",
-                                    [release_id]).fetchone()
+    release_info = database.execute(queries.SELECT_COLLECTION_RELEASE,
+                                    [g.user["user_id"], release_id]).fetchone()
 
     release["price_bought"] = release_info["price_bought"]
     release["date_bought"] = release_info["date_bought"]
@@ -335,10 +578,11 @@ def remove():
     database = get_database()
 
     # Remove anime release from the user's collection
-    database.execute("DELETE FROM anime_collections WHERE user_id = ? AND release_id = ?",
-                     [g.user["user_id"], release_id])
+    database.execute(queries.DELETE_COLLECTION_RELEASE, [g.user["user_id"], release_id])
     database.commit()
 
+    bump_collection_version(g.user["user_id"])
+
     # Redirect back to homepage to show user's updated anime collection
     return redirect(url_for("index"))
 
@@ -357,3 +601,17 @@ def format_date(date):
     date = "/".join(date)
 
     return date
+
+
+@blueprint.app_template_filter("display_date")
+def display_date(date):
+    """Display a date stored as yyyy-mm-dd as mm/dd/yyyy."""
+
+    if not date:
+        return ""
+
+    # Leave anything that isn't a yyyy-mm-dd date as it is
+    if date.count("-") != 2:
+        return date
+
+    return format_date(date)
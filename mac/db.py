@@ -1,42 +1,107 @@
 # Database set up taken directly from:
 # https://flask.palletsprojects.com/en/3.0.x/tutorial/database/
 
+import os
+import queue
 import sqlite3
+import threading
+import time
 
 import click
 from flask import current_app, g
-import xml.etree.ElementTree as ET
+
+from mac import instrumentation
+from mac.cache import bump_collection_version, reset_caches
+
+
+# Only one thread at a time should create a process's connection pool
+pool_lock = threading.Lock()
 
 
 def get_database():
     """Connect to the application's configured database. The connection is
     unique for each request and will be reused if this is called again during
-    the same request.
+    the same request. Between requests, connections are kept open in a pool.
     """
 
     # g is special object that is unique for each request, and is used to store
     # data that can be accessed by multiple functions for the duration of the request
     if "database" not in g:
-        g.database = sqlite3.connect(
-            # Establish a connection to the file pointed at by the "DATABASE" configuration key
-            current_app.config["DATABASE"],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        # Tell the connection to return rows that behave like dicts, in order to access columns by name
-        g.database.row_factory = sqlite3.Row
+        # Reuse an idle connection from this process's pool, or open a new one
+        try:
+            g.database = get_pool().get_nowait()
+        except queue.Empty:
+            g.database = connect()
 
     return g.database
 
 
+def connect():
+    """Open a new connection to the application's configured database, tuned
+    so that readers never wait on a writer.
+    """
+
+    config = current_app.config
+
+    database = sqlite3.connect(
+        # Establish a connection to the file pointed at by the "DATABASE" configuration key
+        config["DATABASE"],
+        detect_types=sqlite3.PARSE_DECLTYPES,
+        # Pooled connections are handed out to whichever thread needs one
+        check_same_thread=False,
+        cached_statements=config["DATABASE_CACHED_STATEMENTS"],
+        # Time each statement when requests are instrumented
+        factory=instrumentation.Connection if config["INSTRUMENTATION"] else sqlite3.Connection
+    )
+    # Tell the connection to return rows that behave like dicts, in order to access columns by name
+    database.row_factory = sqlite3.Row
+
+    # Wait for locks instead of failing straight away, and let readers and a
+    # writer work at the same time through the write-ahead log
+    database.execute(f"PRAGMA busy_timeout = {config['DATABASE_BUSY_TIMEOUT']}")
+    database.execute("PRAGMA journal_mode = WAL")
+    database.execute("PRAGMA synchronous = NORMAL")
+    database.execute(f"PRAGMA mmap_size = {config['DATABASE_MMAP_SIZE']}")
+    database.execute(f"PRAGMA cache_size = {config['DATABASE_CACHE_SIZE']}")
+    database.execute("PRAGMA foreign_keys = ON")
+
+    return database
+
+
+def get_pool():
+    """Return this process's pool of idle database connections. Worker processes
+    forked from a parent get a pool of their own.
+    """
+
+    pool = current_app.extensions.get("database_pool")
+
+    if pool is None or pool[0] != os.getpid():
+        with pool_lock:
+            pool = current_app.extensions.get("database_pool")
+
+            if pool is None or pool[0] != os.getpid():
+                pool = (os.getpid(), queue.LifoQueue(maxsize=current_app.config["DATABASE_POOL_SIZE"]))
+                current_app.extensions["database_pool"] = pool
+
+    return pool[1]
+
+
 def close_database(e=None):
-    """If this request connected to the database, close the connection before
-    sending the response.
+    """If this request connected to the database, return the connection to the
+    pool before sending the response, or close it if the pool is full.
     """
 
     database = g.pop("database", None)
 
     if database is not None:
-        database.close()
+        # Never hand out a connection in the middle of a transaction
+        if database.in_transaction:
+            database.rollback()
+
+        try:
+            get_pool().put_nowait(database)
+        except queue.Full:
+            database.close()
 
 
 def initialize_database():
@@ -45,13 +110,32 @@ def initialize_database():
     # Get connection to database
     database = get_database()
 
+    # Dropping tables that other tables still reference is only allowed
+    # without foreign key enforcement
+    database.execute("PRAGMA foreign_keys = OFF")
+
     # Execute commands in "schema.sql" to create new database
     with current_app.open_resource("schema.sql") as file:
         database.executescript(file.read().decode("utf8"))
 
+    database.execute("PRAGMA foreign_keys = ON")
+
+    # Pages and users cached for the old database must not be shown to new
+    # users who get the same ids
+    reset_caches()
+
+    # Bring the new database up to the latest schema version
+    migrate(database)
+
     # Import anime data from AnimeNewsNetwork
     import_xml(database)
 
+    # Index the imported titles for searching
+    create_search_index(database)
+
+    # Let every process know that the catalog has changed
+    mark_catalog_changed(database)
+
 
 @click.command("initialize-database")
 def initialize_database_command():
@@ -61,13 +145,271 @@ def initialize_database_command():
     click.echo("Initialized the database.")
 
 
+@click.command("sync-catalog")
+@click.argument("path", required=False)
+def sync_catalog_command(path):
+    """Apply changes in a new anime-reports.xml to the anime_shows table,
+    without touching any user data.
+    """
+
+    database = get_database()
+
+    # Syncing relies on tables that migrations create
+    version = database.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < len(list_migrations()):
+        raise click.ClickException(f"The database is at schema version {version}, but syncing needs "
+                                   f"version {len(list_migrations())}. Run \"flask migrate\" first.")
+
+    counts = sync_catalog(database, path or current_app.config["CATALOG_XML"])
+
+    # Index the titles of databases that were created before the search index was
+    if not has_search_index(database) and create_search_index(database):
+        click.echo("Created the search index.")
+
+    # Only invalidate data derived from the catalog if anything actually changed
+    if counts["inserted"] or counts["updated"] or counts["deleted"]:
+        mark_catalog_changed(database)
+
+    click.echo(f"Synced the catalog: {counts['inserted']} inserted, "
+               f"{counts['updated']} updated, {counts['deleted']} deleted, "
+               f"{counts['kept']} kept because they are in a collection.")
+
+
+@click.command("migrate")
+def migrate_command():
+    """Apply any schema migrations the database has not had yet, keeping all data."""
+
+    database = get_database()
+    applied = migrate(database)
+
+    for migration in applied:
+        click.echo(f"Applied migration {migration}.")
+
+    # The search index needs FTS5, which a migration script can't check for, so
+    # databases created before it existed get it here instead
+    if not has_search_index(database):
+        if create_search_index(database):
+            click.echo("Created the search index.")
+        else:
+            click.echo("SQLite was built without FTS5, so searches will use LIKE instead.")
+
+    click.echo(f"Database is at schema version {len(list_migrations())}.")
+
+
+@click.command("check-query-plans")
+@click.option("--verbose", is_flag=True, help="Print the plan of every query, not only of those that scan.")
+def check_query_plans_command(verbose):
+    """Fail if any query run by the views has to scan a whole table."""
+
+    # Imported here, as the views that use the queries need this module
+    from mac.queries import list_view_queries
+
+    database = get_database()
+    checked = 0
+    scans = []
+
+    for name, sql in list_view_queries():
+        # Placeholders only need a value for SQLite to plan the query
+        plan = database.execute(f"EXPLAIN QUERY PLAN {sql}", [None] * sql.count("?")).fetchall()
+        checked += 1
+
+        for step in plan:
+            detail = step["detail"]
+
+            if verbose:
+                click.echo(f"{name}: {detail}")
+
+            # Scanning a full-text index is a lookup, not a full table scan
+            if detail.startswith("SCAN ") and "VIRTUAL TABLE" not in detail:
+                scans.append(f"{name}: {detail}")
+
+    if scans:
+        raise click.ClickException("Queries that scan a whole table:\n" + "\n".join(scans))
+
+    click.echo(f"None of the {checked} view queries scan a whole table.")
+
+
 def initialize_app(app):
     """Register database functions with application instance."""
 
     # Tell Flask to call close_database() when cleaning up after returning a response
     app.teardown_appcontext(close_database)
-    # Add new command that can be called with the "flask" command
+    # Add new commands that can be called with the "flask" command
     app.cli.add_command(initialize_database_command)
+    app.cli.add_command(sync_catalog_command)
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(check_query_plans_command)
+
+
+def list_migrations():
+    """Return the file names of all schema migrations, in the order they apply.
+    A database's PRAGMA user_version is the number of migrations applied to it.
+    """
+
+    return sorted(name for name in os.listdir(os.path.join(current_app.root_path, "migrations"))
+                  if name.endswith(".sql"))
+
+
+def migrate(database):
+    """Apply every migration the database has not had yet, all in one transaction,
+    and return the names of the migrations applied.
+    """
+
+    version = database.execute("PRAGMA user_version").fetchone()[0]
+    migrations = list_migrations()[version:]
+
+    if not migrations:
+        return []
+
+    # Migrations may need to rebuild tables that other tables reference, so
+    # foreign keys are checked once all of them are done instead
+    database.execute("PRAGMA foreign_keys = OFF")
+
+    scripts = []
+
+    for name in migrations:
+        with current_app.open_resource(f"migrations/{name}") as file:
+            scripts.append(file.read().decode("utf8"))
+
+    try:
+        # Record the new schema version in the same transaction as the migrations,
+        # which is left open until foreign keys have been checked
+        database.executescript(f"BEGIN; {';'.join(scripts)}; PRAGMA user_version = {version + len(migrations)};")
+
+        if database.execute("PRAGMA foreign_key_check").fetchone() is not None:
+            raise sqlite3.IntegrityError("Migrating would leave rows with broken foreign keys.")
+
+        database.commit()
+    except sqlite3.Error:
+        database.rollback()
+        raise
+    finally:
+        database.execute("PRAGMA foreign_keys = ON")
+
+    return migrations
+
+
+def catalog_version():
+    """Return a number that changes every time the catalog is imported or
+    synced, or 0 if that has never happened.
+    """
+
+    try:
+        return os.stat(os.path.join(current_app.instance_path, "catalog.version")).st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def mark_catalog_changed(database):
+    """Record that the catalog has changed, so that every process rebuilds
+    anything it has derived from the anime_shows table, and write the new
+    catalog snapshot that processes map in its place.
+    """
+
+    # Imported here, as the typeahead module needs this one. The snapshot is
+    # written first, so that processes seeing the new version find it in place
+    from mac import typeahead
+    typeahead.write_snapshot(database)
+
+    with open(os.path.join(current_app.instance_path, "catalog.version"), "w") as file:
+        file.write(str(time.time_ns()))
+
+
+def has_search_index(database):
+    """Return True if the database has the anime_titles and release_titles
+    full-text indexes.
+    """
+
+    return database.execute("SELECT COUNT(*) FROM sqlite_master "
+                            "WHERE type = 'table' AND name IN ('anime_titles', 'release_titles')").fetchone()[0] == 2
+
+
+def create_search_index(database):
+    """Create full-text indexes over the titles in anime_shows and anime_releases,
+    and the triggers that keep them in sync with those tables. Returns False if
+    this SQLite build does not support FTS5, in which case searches fall back to LIKE.
+    """
+
+    try:
+        database.execute("CREATE VIRTUAL TABLE IF NOT EXISTS anime_titles USING fts5("
+                         "    title,"
+                         "    content = 'anime_shows',"
+                         "    content_rowid = 'anime_id',"
+                         "    tokenize = 'trigram'"
+                         ")")
+    except sqlite3.OperationalError:
+        return False
+
+    # anime_releases has no rowid to point at, so this index keeps its own copy
+    # of each title, under the release's id. Its triggers delete a release's old
+    # title before adding the new one, as INSERT OR REPLACE fails inside upserts
+    database.execute("CREATE VIRTUAL TABLE IF NOT EXISTS release_titles USING fts5("
+                     "    release_title,"
+                     "    tokenize = 'trigram'"
+                     ")")
+
+    # Index every title already in anime_shows and anime_releases in one go
+    with database:
+        database.execute("INSERT INTO anime_titles (anime_titles) VALUES ('rebuild')")
+        database.execute("DELETE FROM release_titles")
+        database.execute("INSERT INTO release_titles (rowid, release_title) "
+                         "SELECT release_id, MAX(release_title) FROM anime_releases GROUP BY release_id")
+
+    # Keep the indexes up to date as anime_shows and anime_releases change
+    database.executescript("""
+        CREATE TRIGGER IF NOT EXISTS anime_titles_insert AFTER INSERT ON anime_shows BEGIN
+            INSERT INTO anime_titles (rowid, title) VALUES (new.anime_id, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS anime_titles_delete AFTER DELETE ON anime_shows BEGIN
+            INSERT INTO anime_titles (anime_titles, rowid, title) VALUES ('delete', old.anime_id, old.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS anime_titles_update AFTER UPDATE OF title ON anime_shows BEGIN
+            INSERT INTO anime_titles (anime_titles, rowid, title) VALUES ('delete', old.anime_id, old.title);
+            INSERT INTO anime_titles (rowid, title) VALUES (new.anime_id, new.title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS release_titles_insert AFTER INSERT ON anime_releases BEGIN
+            DELETE FROM release_titles WHERE rowid = new.release_id;
+            INSERT INTO release_titles (rowid, release_title) VALUES (new.release_id, new.release_title);
+        END;
+        CREATE TRIGGER IF NOT EXISTS release_titles_delete AFTER DELETE ON anime_releases BEGIN
+            DELETE FROM release_titles WHERE rowid = old.release_id;
+        END;
+        CREATE TRIGGER IF NOT EXISTS release_titles_update AFTER UPDATE OF release_title ON anime_releases BEGIN
+            DELETE FROM release_titles WHERE rowid = old.release_id;
+            INSERT INTO release_titles (rowid, release_title) VALUES (new.release_id, new.release_title);
+        END;
+    """)
+
+    return True
+
+
+def iterate_xml(path):
+    """Stream the anime data in anime-reports.xml one <item> at a time, yielding
+    (anime_id, title, type, precision) tuples without building the whole tree.
+    """
+
+    # The XML parser is only loaded when the catalog is imported
+    import xml.etree.ElementTree as ET
+
+    # Only the "start" event of the root element is needed, to be able to clear it
+    context = ET.iterparse(path, events=("start", "end"))
+    _, root = next(context)
+
+    for event, element in context:
+        # Wait until an anime's <item> element has been fully parsed
+        if event != "end" or element.tag != "item":
+            continue
+
+        yield (element.findtext("id"),
+               element.findtext("name"),
+               element.findtext("type"),
+               element.findtext("precision"))
+
+        # Free the parsed element, and drop it from the root, so that memory
+        # used does not grow with the size of the catalog
+        element.clear()
+        root.clear()
 
 
 def import_xml(database):
@@ -75,19 +417,137 @@ def import_xml(database):
     https://www.animenewsnetwork.com/encyclopedia/api.php
     """
 
-    # Parse XML document to get a tree of its elements, and then get the root element
-    tree = ET.parse("./instance/anime-reports.xml")
-    root = tree.getroot()
+    batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+
+    # Relax durability while importing, since a failed import can simply be rerun
+    journal_mode = database.execute("PRAGMA journal_mode").fetchone()[0]
+    synchronous = database.execute("PRAGMA synchronous").fetchone()[0]
+    database.execute(f"PRAGMA journal_mode = {current_app.config['IMPORT_JOURNAL_MODE']}")
+    database.execute(f"PRAGMA synchronous = {current_app.config['IMPORT_SYNCHRONOUS']}")
+
+    # Keep track of how many anime have been imported, and how fast
+    imported = 0
+    start = time.perf_counter()
+
+    batch = []
+
+    try:
+        # Insert anime's data into the anime_shows table in large transactions
+        for anime in iterate_xml(current_app.config["CATALOG_XML"]):
+            batch.append(anime)
+
+            if len(batch) >= batch_size:
+                imported += insert_batch(database, batch)
+                batch.clear()
+                report_progress(imported, start)
+
+        # Insert any anime left over from the last batch
+        if batch:
+            imported += insert_batch(database, batch)
+            report_progress(imported, start)
+    finally:
+        # Restore the connection's previous durability settings, even if the
+        # import failed, as the connection goes back to the pool
+        database.execute(f"PRAGMA journal_mode = {journal_mode}")
+        database.execute(f"PRAGMA synchronous = {synchronous}")
+
+    return imported
+
+
+def insert_batch(database, batch):
+    """Insert a batch of anime into the anime_shows table in one transaction."""
+
+    with database:
+        database.executemany("INSERT INTO anime_shows (anime_id, title, type, precision)"
+                             " VALUES (?, ?, ?, ?)",
+                             batch)
+
+    return len(batch)
+
+
+def report_progress(imported, start):
+    """Print how many anime have been imported so far, and at what rate."""
 
-    # Iterate over each individual anime's data in the XML document
-    for anime in root.findall("item"):
-        title = anime.find("name").text
-        type = anime.find("type").text
-        id = anime.find("id").text
-        precision = anime.find("precision").text
+    elapsed = time.perf_counter() - start
+    rate = imported / elapsed if elapsed else imported
+    click.echo(f"Imported {imported} anime ({rate:,.0f} rows/sec).")
 
-        # Insert anime's data into the anime_shows table in the database
+
+def sync_catalog(database, path):
+    """Diff the anime in the XML document at ``path`` against the anime_shows
+    table and only write the anime that were inserted, updated, or deleted.
+    """
+
+    # Stage the new catalog in a temporary table, so that the diff can be done in SQL
+    database.execute("DROP TABLE IF EXISTS temp.new_shows")
+    database.execute("CREATE TEMP TABLE new_shows ("
+                     "    anime_id INTEGER PRIMARY KEY,"
+                     "    title TEXT NOT NULL,"
+                     "    type TEXT NOT NULL,"
+                     "    precision TEXT NOT NULL"
+                     ")")
+
+    counts = {}
+
+    # Apply the whole diff in a single transaction
+    with database:
+        database.executemany("INSERT OR REPLACE INTO new_shows (anime_id, title, type, precision)"
+                             " VALUES (?, ?, ?, ?)",
+                             iterate_xml(path))
+
+        # Count anime that are new to the catalog
+        counts["inserted"] = database.execute("SELECT COUNT(*) FROM new_shows"
+                                              " WHERE anime_id NOT IN (SELECT anime_id FROM anime_shows)"
+                                              ).fetchone()[0]
+
+        # Count anime whose data has changed since the last import
+        counts["updated"] = database.execute("SELECT COUNT(*)"
+                                             " FROM new_shows JOIN anime_shows USING (anime_id)"
+                                             " WHERE anime_shows.title IS NOT new_shows.title"
+                                             " OR anime_shows.type IS NOT new_shows.type"
+                                             " OR anime_shows.precision IS NOT new_shows.precision"
+                                             ).fetchone()[0]
+
+        # Users with updated anime in their collection, whose pages are rendered again
+        collectors = [row[0] for row in database.execute(
+            "SELECT DISTINCT user_id FROM anime_collections"
+            " WHERE anime_id IN (SELECT anime_id FROM new_shows JOIN anime_shows USING (anime_id)"
+            " WHERE anime_shows.title IS NOT new_shows.title"
+            " OR anime_shows.type IS NOT new_shows.type"
+            " OR anime_shows.precision IS NOT new_shows.precision)"
+        )]
+
+        # Insert new anime and update changed anime, leaving unchanged rows untouched
         database.execute("INSERT INTO anime_shows (anime_id, title, type, precision)"
-                         " VALUES (?, ?, ?, ?)",
-                         [id, title, type, precision])
-        database.commit()
+                         " SELECT anime_id, title, type, precision FROM new_shows WHERE true"
+                         " ON CONFLICT (anime_id) DO UPDATE"
+                         " SET title = excluded.title, type = excluded.type, precision = excluded.precision"
+                         " WHERE title IS NOT excluded.title"
+                         " OR type IS NOT excluded.type"
+                         " OR precision IS NOT excluded.precision")
+
+        # Anime removed from the catalog are kept if any user has them in their collection
+        counts["kept"] = database.execute("SELECT COUNT(*) FROM anime_shows"
+                                          " WHERE anime_id NOT IN (SELECT anime_id FROM new_shows)"
+                                          " AND anime_id IN (SELECT anime_id FROM anime_collections)"
+                                          ).fetchone()[0]
+
+        # Delete the cached releases of removed anime, then the anime themselves
+        database.execute("DELETE FROM anime_releases"
+                         " WHERE anime_id NOT IN (SELECT anime_id FROM new_shows)"
+                         " AND anime_id NOT IN (SELECT anime_id FROM anime_collections)")
+        database.execute("DELETE FROM release_fetches"
+                         " WHERE anime_id NOT IN (SELECT anime_id FROM new_shows)"
+                         " AND anime_id NOT IN (SELECT anime_id FROM anime_collections)")
+        counts["deleted"] = database.execute("DELETE FROM anime_shows"
+                                             " WHERE anime_id NOT IN (SELECT anime_id FROM new_shows)"
+                                             " AND anime_id NOT IN (SELECT anime_id FROM anime_collections)"
+                                             ).rowcount
+
+    database.execute("DROP TABLE temp.new_shows")
+
+    # Only once the diff is committed, so that pages rendered for the new versions show it
+    for user_id in collectors:
+        bump_collection_version(user_id)
+
+    return counts
@@ -0,0 +1,328 @@
+from collections import Counter
+import contextlib
+import heapq
+import hmac
+import re
+import sqlite3
+import threading
+import time
+
+from flask import (
+    Response, before_render_template, current_app, g, has_request_context, request, template_rendered
+)
+from werkzeug.exceptions import abort
+
+# Only one thread at a time should change the collected metrics
+metrics_lock = threading.Lock()
+
+# Parts of the request timed separately, in the order they appear in the Server-Timing header
+TIMINGS = ["sql", "ann", "template"]
+
+
+class Connection(sqlite3.Connection):
+    """Database connection that records how long each statement run through it
+    takes, for the request it runs in.
+    """
+
+    def cursor(self, factory=None):
+        return super().cursor(factory or Cursor)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, script):
+        with record_statement(script):
+            return super().executescript(script)
+
+
+class Cursor(sqlite3.Cursor):
+    """Database cursor that records how long its statements take, including
+    the time spent fetching their rows, as SQLite only runs a query as far as
+    its first row before execute() returns.
+    """
+
+    record = None
+
+    def execute(self, sql, parameters=()):
+        with record_statement(sql) as self.record:
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        with record_statement(sql) as self.record:
+            return super().executemany(sql, parameters)
+
+    def fetch(self, method, *args):
+        """Call one of the cursor's fetch methods, adding the time it takes to
+        the statement's recorded time.
+        """
+
+        if self.record is None:
+            return method(*args)
+
+        start = time.perf_counter()
+
+        try:
+            return method(*args)
+        finally:
+            self.record[0] += time.perf_counter() - start
+
+    def fetchone(self):
+        return self.fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.fetch(super().fetchall)
+
+    def __next__(self):
+        # Called for every row, so kept as short as it can be
+        if self.record is None:
+            return super().__next__()
+
+        start = time.perf_counter()
+
+        try:
+            return super().__next__()
+        finally:
+            self.record[0] += time.perf_counter() - start
+
+
+def get_shape(sql):
+    """Return the shape of an SQL statement, which is the same for statements
+    that only differ by their values or the length of their lists of values.
+    """
+
+    shape = " ".join(sql.split())
+    shape = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", "?", shape)
+    shape = re.sub(r"\(\?(?:, \?)+\)", "(?, ...)", shape)
+
+    return shape
+
+
+def is_recording():
+    """Return True if the current request's timings are being recorded."""
+
+    return has_request_context() and "timings" in g
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Context manager adding the time spent in its block to the current
+    request's timing called ``name``, if timings are being recorded.
+    """
+
+    if not is_recording():
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        g.timings[name] += time.perf_counter() - start
+
+
+@contextlib.contextmanager
+def record_statement(sql):
+    """Context manager recording a statement run in its block, and how long it
+    took. Gives the statement's record, the time spent on it first, so that
+    time spent fetching its rows can be added to it, or None if timings are
+    not being recorded.
+    """
+
+    if not is_recording():
+        yield None
+        return
+
+    record = [0, sql]
+    g.statements.append(record)
+
+    start = time.perf_counter()
+
+    try:
+        yield record
+    finally:
+        record[0] += time.perf_counter() - start
+
+
+class Metrics:
+    """Totals of what each endpoint spent its time on, in this process, along
+    with the slowest statements run by any of them.
+    """
+
+    def __init__(self, slowest):
+        self.requests = Counter()
+        self.seconds = Counter()
+        self.statements = Counter()
+        self.timings = {name: Counter() for name in TIMINGS}
+        self.slowest_size = slowest
+        self.slowest = []
+
+    def add(self, endpoint, seconds, timings, statements):
+        with metrics_lock:
+            self.requests[endpoint] += 1
+            self.seconds[endpoint] += seconds
+            self.statements[endpoint] += len(statements)
+
+            for name in TIMINGS:
+                self.timings[name][endpoint] += timings[name]
+
+            # Keep the slowest statements in a heap, the fastest of them first
+            for elapsed, sql in statements:
+                if len(self.slowest) < self.slowest_size:
+                    heapq.heappush(self.slowest, (elapsed, endpoint, get_shape(sql)))
+                elif elapsed > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, (elapsed, endpoint, get_shape(sql)))
+
+    def render(self):
+        """Return the metrics in the Prometheus text format."""
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+
+            for labels, value in samples:
+                labels = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        with metrics_lock:
+            metric("mac_requests_total", "counter", "Requests served.",
+                   [({"endpoint": endpoint}, count) for endpoint, count in self.requests.items()])
+            metric("mac_request_seconds_total", "counter", "Seconds spent serving requests.",
+                   [({"endpoint": endpoint}, seconds) for endpoint, seconds in self.seconds.items()])
+            metric("mac_sql_statements_total", "counter", "SQL statements run.",
+                   [({"endpoint": endpoint}, count) for endpoint, count in self.statements.items()])
+
+            for name in TIMINGS:
+                metric(f"mac_{name}_seconds_total", "counter", f"Seconds spent on {name} while serving requests.",
+                       [({"endpoint": endpoint}, seconds) for endpoint, seconds in self.timings[name].items()])
+
+            metric("mac_slowest_sql_seconds", "gauge", "Slowest SQL statements run so far.",
+                   [({"endpoint": endpoint, "statement": shape}, elapsed)
+                    for elapsed, endpoint, shape in sorted(self.slowest, reverse=True)])
+
+        return "\n".join(lines) + "\n"
+
+
+def escape(value):
+    """Escape a Prometheus label value."""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_request():
+    """Start recording the current request's timings."""
+
+    g.started = time.perf_counter()
+    g.timings = Counter()
+    g.statements = []
+
+
+def finish_request(response):
+    """Add the current request's timings to the metrics, report them to the
+    browser in a Server-Timing header, and warn if a statement was run many
+    times over.
+    """
+
+    if "timings" not in g:
+        return response
+
+    elapsed = time.perf_counter() - g.started
+    endpoint = request.endpoint or "unknown"
+
+    # Statements keep adding to their time while their rows are fetched, so they are only added up now
+    g.timings["sql"] = sum(seconds for seconds, _ in g.statements)
+
+    # Don't let requests for the metrics skew them
+    if endpoint != "metrics":
+        current_app.extensions["metrics"].add(endpoint, elapsed, g.timings, g.statements)
+
+    # Likely a query run once per row of another query's results, instead of once for all of them
+    limit = current_app.config["INSTRUMENTATION_REPEAT_LIMIT"]
+
+    for shape, count in Counter(get_shape(sql) for _, sql in g.statements).items():
+        if count > limit:
+            current_app.logger.warning("%s ran the same statement %d times in one request: %s",
+                                       endpoint, count, shape)
+
+    # Durations are given in milliseconds
+    timings = [f'{name};dur={g.timings[name] * 1000:.1f}' for name in TIMINGS]
+    timings[0] += f';desc="{len(g.statements)} statements"'
+    timings.append(f"total;dur={elapsed * 1000:.1f}")
+
+    response.headers.add("Server-Timing", ", ".join(timings))
+
+    return response
+
+
+def start_template(sender, template, context, **extra):
+    """Remember when rendering a template started."""
+
+    if is_recording():
+        g.template_started = time.perf_counter()
+
+
+def finish_template(sender, template, context, **extra):
+    """Add the time spent rendering a template to the current request's timings."""
+
+    if is_recording() and "template_started" in g:
+        g.timings["template"] += time.perf_counter() - g.pop("template_started")
+
+
+def metrics_allowed():
+    """Return True if the current request may read the metrics: with the
+    METRICS_TOKEN as a bearer token if one is configured, or otherwise from one
+    of the METRICS_ALLOWED_ADDRESSES.
+    """
+
+    token = current_app.config["METRICS_TOKEN"]
+
+    if token:
+        scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+
+        # Compare in constant time, so that the token can't be guessed from how long a check takes
+        return scheme.lower() == "bearer" and hmac.compare_digest(given.strip().encode(), token.encode())
+
+    return request.remote_addr in current_app.config["METRICS_ALLOWED_ADDRESSES"]
+
+
+def metrics():
+    """Serve this process's metrics for Prometheus to scrape. Each worker
+    process keeps metrics of its own. They include the text of the slowest
+    statements, so only allowed clients may read them.
+    """
+
+    # Don't reveal that the metrics exist to anyone else
+    if not metrics_allowed():
+        abort(404)
+
+    return Response(current_app.extensions["metrics"].render(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def initialize_app(app):
+    """Record where each request spends its time, if the INSTRUMENTATION
+    config is set. Does nothing otherwise, so that requests don't pay for it.
+    """
+
+    if not app.config["INSTRUMENTATION"]:
+        return
+
+    app.extensions["metrics"] = Metrics(app.config["INSTRUMENTATION_SLOWEST"])
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+    before_render_template.connect(start_template, app)
+    template_rendered.connect(finish_template, app)
+
+    # Imported here, as the auth blueprint needs the database, which needs this module
+    from mac.auth import user_not_needed
+    app.add_url_rule("/metrics", view_func=user_not_needed(metrics))
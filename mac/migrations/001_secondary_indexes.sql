@@ -0,0 +1,15 @@
+-- Look up a show's releases by anime_id, for the details page
+CREATE INDEX IF NOT EXISTS anime_releases_anime_id ON anime_releases (anime_id);
+
+-- Look up collected releases by show, and a user's releases by when they were added
+CREATE INDEX IF NOT EXISTS anime_collections_anime_id ON anime_collections (anime_id);
+CREATE INDEX IF NOT EXISTS anime_collections_date_added ON anime_collections (user_id, date_added);
+
+-- Databases made before usernames were unique may have duplicates. The oldest
+-- account keeps the username, and the others have their user_id appended to it,
+-- which is what they log in with from now on
+UPDATE users SET username = username || '-' || user_id
+WHERE user_id NOT IN (SELECT MIN(user_id) FROM users GROUP BY username);
+
+-- Look up users by username when logging in, and prevent duplicate usernames
+CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users (username);
@@ -0,0 +1,27 @@
+-- A release_id alone does not identify a row in anime_releases, so reference
+-- releases by their whole primary key. SQLite can only change a foreign key
+-- by rebuilding the table.
+CREATE TABLE anime_collections_new (
+    user_id INTEGER NOT NULL,
+    anime_id INTEGER NOT NULL,
+    release_id INTEGER NOT NULL,
+    price_bought INTEGER,
+    date_bought TEXT,
+    store_bought TEXT,
+    comment TEXT,
+    date_added TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    FOREIGN KEY (anime_id) REFERENCES anime_shows (anime_id),
+    FOREIGN KEY (release_id, anime_id) REFERENCES anime_releases (release_id, anime_id),
+    PRIMARY KEY (user_id, release_id)
+);
+
+INSERT INTO anime_collections_new (user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment, date_added)
+SELECT user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment, date_added
+FROM anime_collections;
+
+DROP TABLE anime_collections;
+ALTER TABLE anime_collections_new RENAME TO anime_collections;
+
+CREATE INDEX anime_collections_anime_id ON anime_collections (anime_id);
+CREATE INDEX anime_collections_date_added ON anime_collections (user_id, date_added);
@@ -0,0 +1,11 @@
+-- Remember when each anime's releases were last fetched from ANN, including
+-- anime that turned out to have no releases
+CREATE TABLE release_fetches (
+    anime_id INTEGER PRIMARY KEY,
+    fetched_at INTEGER NOT NULL,
+    FOREIGN KEY (anime_id) REFERENCES anime_shows (anime_id)
+);
+
+-- Anime already in anime_releases were fetched at some point in the past
+INSERT INTO release_fetches (anime_id, fetched_at)
+SELECT DISTINCT anime_id, 0 FROM anime_releases;
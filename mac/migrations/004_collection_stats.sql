@@ -0,0 +1,114 @@
+-- Store purchase dates as yyyy-mm-dd, which sorts and groups correctly,
+-- instead of mm/dd/yyyy, and store missing prices and dates as NULL
+UPDATE anime_collections
+SET date_bought = substr(date_bought, 7, 4) || '-' || substr(date_bought, 1, 2) || '-' || substr(date_bought, 4, 2)
+WHERE date_bought LIKE '__/__/____';
+
+UPDATE anime_collections SET date_bought = NULL WHERE date_bought = '';
+UPDATE anime_collections SET price_bought = NULL WHERE price_bought = '';
+
+-- Look up who has collected a release, when the release's data changes
+CREATE INDEX anime_collections_release_id ON anime_collections (release_id, anime_id);
+
+-- Number of releases in each user's collection and how much they spent on
+-- them, in total and broken down by disc type, edition, store, and month bought.
+-- Kept up to date by the triggers below as collections change
+CREATE TABLE collection_stats (
+    user_id INTEGER NOT NULL,
+    dimension TEXT NOT NULL,
+    value TEXT NOT NULL,
+    items INTEGER NOT NULL,
+    spend REAL NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    PRIMARY KEY (user_id, dimension, value)
+);
+
+CREATE TRIGGER collection_stats_insert AFTER INSERT ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT NEW.user_id, dimension, value, 1, COALESCE(NEW.price_bought, 0) FROM (
+        SELECT 'total' AS dimension, '' AS value
+        UNION ALL SELECT 'disc_type', disc_type FROM anime_releases WHERE release_id = NEW.release_id AND anime_id = NEW.anime_id
+        UNION ALL SELECT 'edition', edition FROM anime_releases WHERE release_id = NEW.release_id AND anime_id = NEW.anime_id
+        UNION ALL SELECT 'store', COALESCE(NEW.store_bought, '')
+        UNION ALL SELECT 'month', COALESCE(substr(NEW.date_bought, 1, 7), '')
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+END;
+
+CREATE TRIGGER collection_stats_delete AFTER DELETE ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT OLD.user_id, dimension, value, -1, -COALESCE(OLD.price_bought, 0) FROM (
+        SELECT 'total' AS dimension, '' AS value
+        UNION ALL SELECT 'disc_type', disc_type FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT 'edition', edition FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT 'store', COALESCE(OLD.store_bought, '')
+        UNION ALL SELECT 'month', COALESCE(substr(OLD.date_bought, 1, 7), '')
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE user_id = OLD.user_id AND items <= 0;
+END;
+
+CREATE TRIGGER collection_stats_update AFTER UPDATE OF price_bought, date_bought, store_bought ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT user_id, dimension, value, items, spend FROM (
+        SELECT OLD.user_id AS user_id, 'total' AS dimension, '' AS value, 0 AS items,
+               COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0) AS spend
+        UNION ALL SELECT OLD.user_id, 'disc_type', disc_type, 0, COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0)
+        FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT OLD.user_id, 'edition', edition, 0, COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0)
+        FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT OLD.user_id, 'store', COALESCE(OLD.store_bought, ''), -1, -COALESCE(OLD.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'store', COALESCE(NEW.store_bought, ''), 1, COALESCE(NEW.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'month', COALESCE(substr(OLD.date_bought, 1, 7), ''), -1, -COALESCE(OLD.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'month', COALESCE(substr(NEW.date_bought, 1, 7), ''), 1, COALESCE(NEW.price_bought, 0)
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE user_id = OLD.user_id AND items <= 0;
+END;
+
+-- Move collected releases to their new disc type or edition when a release's data is refreshed
+CREATE TRIGGER collection_stats_release_update AFTER UPDATE OF disc_type, edition ON anime_releases
+WHEN OLD.disc_type IS NOT NEW.disc_type OR OLD.edition IS NOT NEW.edition BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT user_id, dimension, value, items, spend FROM (
+        SELECT user_id, 'disc_type' AS dimension, OLD.disc_type AS value, -1 AS items, -COALESCE(price_bought, 0) AS spend
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'disc_type', NEW.disc_type, 1, COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'edition', OLD.edition, -1, -COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'edition', NEW.edition, 1, COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE items <= 0
+    AND user_id IN (SELECT user_id FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id);
+END;
+
+-- Count the collections that already exist
+INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+SELECT user_id, 'total', '', COUNT(*), TOTAL(price_bought)
+FROM anime_collections GROUP BY user_id;
+
+INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+SELECT user_id, 'disc_type', disc_type, COUNT(*), TOTAL(price_bought)
+FROM anime_collections JOIN anime_releases USING (release_id, anime_id) GROUP BY user_id, disc_type;
+
+INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+SELECT user_id, 'edition', edition, COUNT(*), TOTAL(price_bought)
+FROM anime_collections JOIN anime_releases USING (release_id, anime_id) GROUP BY user_id, edition;
+
+INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+SELECT user_id, 'store', COALESCE(store_bought, ''), COUNT(*), TOTAL(price_bought)
+FROM anime_collections GROUP BY user_id, COALESCE(store_bought, '');
+
+INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+SELECT user_id, 'month', COALESCE(substr(date_bought, 1, 7), ''), COUNT(*), TOTAL(price_bought)
+FROM anime_collections GROUP BY user_id, COALESCE(substr(date_bought, 1, 7), '');
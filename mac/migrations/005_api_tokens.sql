@@ -0,0 +1,11 @@
+-- Tokens that let API clients act as a user without a session cookie. Only
+-- the SHA-256 of each token is stored, so that a copy of the database can't be
+-- used to log in
+CREATE TABLE api_tokens (
+    token_hash TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id)
+);
+
+CREATE INDEX api_tokens_user_id ON api_tokens (user_id);
@@ -0,0 +1,132 @@
+-- Store releases and collections clustered by their primary keys, so that
+-- reading a user's collection, and the release of each item in it, takes one
+-- b-tree lookup per row instead of one in the primary key index and another in
+-- the table. SQLite can only do this by rebuilding both tables, which drops
+-- their indexes and triggers, so they are created again below.
+DROP TRIGGER collection_stats_insert;
+DROP TRIGGER collection_stats_delete;
+DROP TRIGGER collection_stats_update;
+DROP TRIGGER collection_stats_release_update;
+
+CREATE TABLE anime_releases_new (
+    release_id INTEGER NOT NULL,
+    anime_id INTEGER NOT NULL,
+    release_title TEXT NOT NULL,
+    disc_type TEXT NOT NULL,
+    edition TEXT NOT NULL DEFAULT "Standard",
+    release_date TEXT NOT NULL,
+    image TEXT,
+    FOREIGN KEY (anime_id) REFERENCES anime_shows (anime_id),
+    PRIMARY KEY (release_id, anime_id)
+) WITHOUT ROWID;
+
+INSERT INTO anime_releases_new (release_id, anime_id, release_title, disc_type, edition, release_date, image)
+SELECT release_id, anime_id, release_title, disc_type, edition, release_date, image
+FROM anime_releases;
+
+DROP TABLE anime_releases;
+ALTER TABLE anime_releases_new RENAME TO anime_releases;
+
+CREATE INDEX anime_releases_anime_id ON anime_releases (anime_id);
+
+CREATE TABLE anime_collections_new (
+    user_id INTEGER NOT NULL,
+    anime_id INTEGER NOT NULL,
+    release_id INTEGER NOT NULL,
+    price_bought INTEGER,
+    date_bought TEXT,
+    store_bought TEXT,
+    comment TEXT,
+    date_added TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES users (user_id),
+    FOREIGN KEY (anime_id) REFERENCES anime_shows (anime_id),
+    FOREIGN KEY (release_id, anime_id) REFERENCES anime_releases (release_id, anime_id),
+    PRIMARY KEY (user_id, release_id)
+) WITHOUT ROWID;
+
+INSERT INTO anime_collections_new (user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment, date_added)
+SELECT user_id, anime_id, release_id, price_bought, date_bought, store_bought, comment, date_added
+FROM anime_collections;
+
+DROP TABLE anime_collections;
+ALTER TABLE anime_collections_new RENAME TO anime_collections;
+
+CREATE INDEX anime_collections_anime_id ON anime_collections (anime_id);
+CREATE INDEX anime_collections_date_added ON anime_collections (user_id, date_added);
+CREATE INDEX anime_collections_release_id ON anime_collections (release_id, anime_id);
+
+-- Filter a user's collection by store, purchase date, and price without reading
+-- the rest of it. Filters on a release's disc type, edition, and title are
+-- checked on the release each item is joined to through its primary key
+CREATE INDEX anime_collections_store_bought ON anime_collections (user_id, store_bought);
+CREATE INDEX anime_collections_date_bought ON anime_collections (user_id, date_bought);
+CREATE INDEX anime_collections_price_bought ON anime_collections (user_id, price_bought);
+
+CREATE TRIGGER collection_stats_insert AFTER INSERT ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT NEW.user_id, dimension, value, 1, COALESCE(NEW.price_bought, 0) FROM (
+        SELECT 'total' AS dimension, '' AS value
+        UNION ALL SELECT 'disc_type', disc_type FROM anime_releases WHERE release_id = NEW.release_id AND anime_id = NEW.anime_id
+        UNION ALL SELECT 'edition', edition FROM anime_releases WHERE release_id = NEW.release_id AND anime_id = NEW.anime_id
+        UNION ALL SELECT 'store', COALESCE(NEW.store_bought, '')
+        UNION ALL SELECT 'month', COALESCE(substr(NEW.date_bought, 1, 7), '')
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+END;
+
+CREATE TRIGGER collection_stats_delete AFTER DELETE ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT OLD.user_id, dimension, value, -1, -COALESCE(OLD.price_bought, 0) FROM (
+        SELECT 'total' AS dimension, '' AS value
+        UNION ALL SELECT 'disc_type', disc_type FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT 'edition', edition FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT 'store', COALESCE(OLD.store_bought, '')
+        UNION ALL SELECT 'month', COALESCE(substr(OLD.date_bought, 1, 7), '')
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE user_id = OLD.user_id AND items <= 0;
+END;
+
+CREATE TRIGGER collection_stats_update AFTER UPDATE OF price_bought, date_bought, store_bought ON anime_collections BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT user_id, dimension, value, items, spend FROM (
+        SELECT OLD.user_id AS user_id, 'total' AS dimension, '' AS value, 0 AS items,
+               COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0) AS spend
+        UNION ALL SELECT OLD.user_id, 'disc_type', disc_type, 0, COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0)
+        FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT OLD.user_id, 'edition', edition, 0, COALESCE(NEW.price_bought, 0) - COALESCE(OLD.price_bought, 0)
+        FROM anime_releases WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT OLD.user_id, 'store', COALESCE(OLD.store_bought, ''), -1, -COALESCE(OLD.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'store', COALESCE(NEW.store_bought, ''), 1, COALESCE(NEW.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'month', COALESCE(substr(OLD.date_bought, 1, 7), ''), -1, -COALESCE(OLD.price_bought, 0)
+        UNION ALL SELECT OLD.user_id, 'month', COALESCE(substr(NEW.date_bought, 1, 7), ''), 1, COALESCE(NEW.price_bought, 0)
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE user_id = OLD.user_id AND items <= 0;
+END;
+
+-- Move collected releases to their new disc type or edition when a release's data is refreshed
+CREATE TRIGGER collection_stats_release_update AFTER UPDATE OF disc_type, edition ON anime_releases
+WHEN OLD.disc_type IS NOT NEW.disc_type OR OLD.edition IS NOT NEW.edition BEGIN
+    INSERT INTO collection_stats (user_id, dimension, value, items, spend)
+    SELECT user_id, dimension, value, items, spend FROM (
+        SELECT user_id, 'disc_type' AS dimension, OLD.disc_type AS value, -1 AS items, -COALESCE(price_bought, 0) AS spend
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'disc_type', NEW.disc_type, 1, COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'edition', OLD.edition, -1, -COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+        UNION ALL SELECT user_id, 'edition', NEW.edition, 1, COALESCE(price_bought, 0)
+        FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id
+    ) WHERE true
+    ON CONFLICT (user_id, dimension, value) DO UPDATE
+    SET items = items + excluded.items, spend = spend + excluded.spend;
+
+    DELETE FROM collection_stats WHERE items <= 0
+    AND user_id IN (SELECT user_id FROM anime_collections WHERE release_id = OLD.release_id AND anime_id = OLD.anime_id);
+END;
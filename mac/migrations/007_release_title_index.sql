@@ -0,0 +1,2 @@
+-- Look up releases by their exact title, when importing a collection
+CREATE INDEX IF NOT EXISTS anime_releases_release_title ON anime_releases (release_title);
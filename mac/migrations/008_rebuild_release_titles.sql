@@ -0,0 +1,7 @@
+-- The release_titles triggers used INSERT OR REPLACE, which fails inside the
+-- upserts that store releases. Drop the index and its triggers, so that
+-- "flask migrate" creates them again with triggers that delete the old title first
+DROP TRIGGER IF EXISTS release_titles_insert;
+DROP TRIGGER IF EXISTS release_titles_delete;
+DROP TRIGGER IF EXISTS release_titles_update;
+DROP TABLE IF EXISTS release_titles;
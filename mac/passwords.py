@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+import click
+from flask import current_app
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Number of password hashes running or waiting to run in this process
+pending = 0
+pending_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the application's pool of threads that hash passwords, which
+    limits how many slow hashes run at the same time.
+    """
+
+    if "password_hasher" not in current_app.extensions:
+        with pending_lock:
+            current_app.extensions.setdefault(
+                "password_hasher",
+                ThreadPoolExecutor(max_workers=current_app.config["PASSWORD_HASH_WORKERS"])
+            )
+
+    return current_app.extensions["password_hasher"]
+
+
+def run(function, *args):
+    """Run a password hashing function on the pool and wait for its result.
+    Responds with 429 Too Many Requests instead of waiting if too many hashes
+    are already queued.
+    """
+
+    global pending
+
+    with pending_lock:
+        if pending >= current_app.config["PASSWORD_HASH_QUEUE"]:
+            raise TooManyRequests("Too many people are logging in right now. Please try again.",
+                                  retry_after=1)
+        pending += 1
+
+    try:
+        return get_executor().submit(function, *args).result()
+    finally:
+        with pending_lock:
+            pending -= 1
+
+
+def get_method():
+    """Return the configured hash method with all of its parameters spelled out,
+    such as "scrypt:32768:8:1", which is how it appears in stored hashes.
+    """
+
+    method = current_app.config["PASSWORD_HASH_METHOD"]
+
+    if "password_hash_method" not in current_app.extensions:
+        current_app.extensions["password_hash_method"] = generate_password_hash("", method).split("$", 1)[0]
+
+    return current_app.extensions["password_hash_method"]
+
+
+def hash_password(password):
+    """Hash a password with the configured method, on the hashing pool."""
+
+    return run(generate_password_hash, password, current_app.config["PASSWORD_HASH_METHOD"])
+
+
+def check_password(password_hash, password):
+    """Check a password against its stored hash, on the hashing pool."""
+
+    return run(check_password_hash, password_hash, password)
+
+
+def needs_rehash(password_hash):
+    """Return True if a stored hash was made with other settings than the
+    configured ones.
+    """
+
+    return password_hash.split("$", 1)[0] != get_method()
+
+
+@click.command("benchmark-passwords")
+@click.argument("methods", nargs=-1)
+@click.option("--logins", default=20, help="Number of logins to time for each method.")
+def benchmark_passwords_command(methods, logins):
+    """Report how many logins per second each hash method allows, using the
+    configured method if none are given.
+    """
+
+    workers = current_app.config["PASSWORD_HASH_WORKERS"]
+
+    for method in methods or [current_app.config["PASSWORD_HASH_METHOD"]]:
+        password_hash = generate_password_hash("password", method)
+
+        # Check passwords on as many threads as the hashing pool has
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            start = time.perf_counter()
+            list(executor.map(check_password_hash, [password_hash] * logins, ["password"] * logins))
+            elapsed = time.perf_counter() - start
+
+        click.echo(f"{password_hash.split('$', 1)[0]}: {logins / elapsed:,.1f} logins/sec "
+                   f"with {workers} workers")
+
+
+def initialize_app(app):
+    """Register the password benchmark command with the application instance."""
+
+    app.cli.add_command(benchmark_passwords_command)
@@ -0,0 +1,223 @@
+import itertools
+
+# SQL run by the views, defined once here so that "flask check-query-plans"
+# checks the very queries the views run. Queries whose text depends on the
+# request are built by the functions further down
+
+# Load the logged in user, leaving out the password hash
+SELECT_LOGGED_IN_USER = "SELECT user_id, username FROM users WHERE user_id = ?"
+
+# Look up a user logging in, with their password hash
+SELECT_USER_BY_USERNAME = "SELECT * FROM users WHERE username = ?"
+
+# Store a user's password hashed again with new settings
+UPDATE_USER_PASSWORD = "UPDATE users SET password = ? WHERE user_id = ?"
+
+# Disc types, editions, and stores in a user's collection, offered as filters
+SELECT_FILTER_CHOICES = ("SELECT dimension, value FROM collection_stats "
+                         "WHERE user_id = ? AND dimension IN ('disc_type', 'edition', 'store') "
+                         "ORDER BY dimension, value")
+
+# Search anime titles through the anime_titles full-text index, best matches first
+SEARCH_TITLES = ("SELECT anime_shows.* "
+                 "FROM anime_titles JOIN anime_shows ON anime_shows.anime_id = anime_titles.rowid "
+                 "WHERE anime_titles MATCH ? "
+                 "ORDER BY anime_titles.rank LIMIT ?")
+
+# Search anime titles when SQLite was built without FTS5, which has to scan anime_shows
+SEARCH_TITLES_WITHOUT_INDEX = "SELECT * FROM anime_shows WHERE title LIKE ? ORDER BY title LIMIT ?"
+
+# An anime's title, when its releases were last fetched, and the releases
+# themselves. An anime with no releases still gets one row
+SELECT_ANIME_DETAILS = ("SELECT anime_shows.title, release_fetches.fetched_at, anime_releases.* "
+                        "FROM anime_shows "
+                        "LEFT JOIN release_fetches ON release_fetches.anime_id = anime_shows.anime_id "
+                        "LEFT JOIN anime_releases ON anime_releases.anime_id = anime_shows.anime_id "
+                        "WHERE anime_shows.anime_id = ?")
+
+# Title of a release, for messages and the edit page
+SELECT_RELEASE_TITLE = "SELECT release_title FROM anime_releases WHERE release_id = ?"
+
+# A user's information about a release in their collection
+SELECT_COLLECTION_RELEASE = ("SELECT price_bought, date_bought, store_bought, comment "
+                             "FROM anime_collections "
+                             "WHERE user_id = ? AND release_id = ?")
+
+# Change a user's information about a release in their collection
+UPDATE_COLLECTION_RELEASE = ("UPDATE anime_collections "
+                             "SET price_bought = ?, date_bought = ?, store_bought = ?, comment = ? "
+                             "WHERE user_id = ? AND release_id = ?")
+
+# Remove a release from a user's collection
+DELETE_COLLECTION_RELEASE = "DELETE FROM anime_collections WHERE user_id = ? AND release_id = ?"
+
+# Find a release an imported row refers to by its id
+SELECT_RELEASE_BY_ID = "SELECT release_id, anime_id FROM anime_releases WHERE release_id = ? LIMIT 1"
+
+# Find a release an imported row refers to by its exact title
+SELECT_RELEASE_BY_TITLE = "SELECT release_id, anime_id FROM anime_releases WHERE release_title = ? LIMIT 1"
+
+# Releases whose titles match a full-text query, to compare an imported title against
+SELECT_RELEASE_CANDIDATES = ("SELECT anime_releases.release_id, anime_id, anime_releases.release_title "
+                             "FROM release_titles "
+                             "JOIN anime_releases ON anime_releases.release_id = release_titles.rowid "
+                             "WHERE release_titles MATCH ? LIMIT ?")
+
+# Releases to compare an imported title against when SQLite was built without
+# FTS5, which has to scan anime_releases
+SELECT_RELEASE_CANDIDATES_WITHOUT_INDEX = ("SELECT release_id, anime_id, release_title FROM anime_releases "
+                                           "WHERE release_title LIKE ? LIMIT ?")
+
+# Every release in a user's collection, as it is exported
+SELECT_EXPORTED_COLLECTION = ("SELECT anime_releases.release_id, release_title, "
+                              "price_bought, date_bought, store_bought, comment "
+                              "FROM anime_collections "
+                              "JOIN anime_releases ON anime_releases.release_id = anime_collections.release_id "
+                              "AND anime_releases.anime_id = anime_collections.anime_id "
+                              "WHERE anime_collections.user_id = ? "
+                              "ORDER BY release_title")
+
+# Image of a release, to cache as its thumbnail
+SELECT_RELEASE_IMAGE = "SELECT image FROM anime_releases WHERE release_id = ? LIMIT 1"
+
+# A user's collection statistics, largest first
+SELECT_COLLECTION_STATS = ("SELECT dimension, value, items, spend "
+                           "FROM collection_stats "
+                           "WHERE user_id = ? "
+                           "ORDER BY dimension, items DESC, value")
+
+# The user an API token belongs to
+SELECT_TOKEN_USER = ("SELECT users.user_id, username "
+                     "FROM api_tokens JOIN users ON users.user_id = api_tokens.user_id "
+                     "WHERE token_hash = ?")
+
+# Revoke an API token
+DELETE_TOKEN = "DELETE FROM api_tokens WHERE token_hash = ?"
+
+# Fields of a release in a collection that API clients may ask for, mapped to
+# the SQL expression each is read from
+COLLECTION_FIELDS = {
+    "release_id": "anime_releases.release_id",
+    "anime_id": "anime_releases.anime_id",
+    "release_title": "release_title",
+    "disc_type": "disc_type",
+    "edition": "edition",
+    "release_date": "release_date",
+    "image": "image",
+    "price_bought": "price_bought",
+    "date_bought": "date_bought",
+    "store_bought": "store_bought",
+    "comment": "comment",
+    "date_added": "date_added",
+}
+
+
+def placeholders(count):
+    """Return ``count`` placeholders for an IN list."""
+
+    return ", ".join("?" * count)
+
+
+def select_collection_page(key, order, conditions):
+    """Return the query that reads one page of the collection page's releases
+    matching ``conditions``, sorted by the SQL expression ``key``.
+    """
+
+    return (f"SELECT {key} AS sort_key, release_title, anime_releases.release_id, image, "
+            "price_bought, date_bought, store_bought, comment "
+            "FROM anime_collections "
+            "JOIN anime_releases ON anime_releases.release_id = anime_collections.release_id "
+            "AND anime_releases.anime_id = anime_collections.anime_id "
+            f"WHERE {' AND '.join(conditions)} "
+            f"ORDER BY sort_key {order}, anime_releases.release_id {order} "
+            "LIMIT ?")
+
+
+def select_collectors(count):
+    """Return the query that finds the users with releases of any of ``count``
+    anime in their collection.
+    """
+
+    return f"SELECT DISTINCT user_id FROM anime_collections WHERE anime_id IN ({placeholders(count)})"
+
+
+def select_collection(fields, conditions, paged=False):
+    """Return the query that reads ``fields`` of the releases in a user's
+    collection matching ``conditions``. Paged queries are ordered by release_id
+    and take how many releases to read as their last parameter.
+    """
+
+    columns = ", ".join(f"{COLLECTION_FIELDS[field]} AS {field}" for field in fields)
+
+    return (f"SELECT {columns} "
+            "FROM anime_collections "
+            "JOIN anime_releases ON anime_releases.release_id = anime_collections.release_id "
+            "AND anime_releases.anime_id = anime_collections.anime_id "
+            f"WHERE {' AND '.join(conditions)}"
+            + (" ORDER BY anime_collections.release_id LIMIT ?" if paged else ""))
+
+
+def select_existing(count):
+    """Return the query that finds which of ``count`` releases are in a user's collection."""
+
+    return f"SELECT release_id FROM anime_collections WHERE user_id = ? AND release_id IN ({placeholders(count)})"
+
+
+def select_anime_ids(count):
+    """Return the query that looks up the anime of ``count`` releases."""
+
+    return f"SELECT release_id, anime_id FROM anime_releases WHERE release_id IN ({placeholders(count)})"
+
+
+def update_collection_fields(fields):
+    """Return the statement that changes ``fields`` of a release in a user's collection."""
+
+    assignments = ", ".join(f"{field} = ?" for field in fields)
+
+    return f"UPDATE anime_collections SET {assignments} WHERE user_id = ? AND release_id = ?"
+
+
+def list_view_queries():
+    """Yield the name and SQL of every query the views run, in every form they
+    can take, for "flask check-query-plans". The searches used when SQLite was
+    built without FTS5 are left out, as they scan a whole table by design.
+    """
+
+    # Imported here, as the collection module needs this one
+    from mac.collection import FILTERS, SORT_KEYS
+
+    for name, sql in globals().items():
+        if name.isupper() and isinstance(sql, str) and not name.endswith("_WITHOUT_INDEX"):
+            yield name, sql
+
+    # The collection page, sorted each way, with every combination of filters,
+    # on its first page and on later ones
+    for sort, (key, _) in SORT_KEYS.items():
+        for order in ("asc", "desc"):
+            for count in range(len(FILTERS) + 1):
+                for filters in itertools.combinations(FILTERS, count):
+                    for paged in (False, True):
+                        conditions = ["anime_collections.user_id = ?"]
+                        conditions.extend(FILTERS[field][0] for field in filters)
+
+                        if paged:
+                            conditions.append(f"({key}, anime_releases.release_id) "
+                                              f"{'>' if order == 'asc' else '<'} (?, ?)")
+
+                        yield (f"index sort={sort} order={order} filters={','.join(filters) or 'none'}"
+                               f"{' after' if paged else ''}",
+                               select_collection_page(key, order, conditions))
+
+    yield "select_collectors", select_collectors(2)
+
+    # The JSON API's collection, a page at a time and one release at a time
+    fields = list(COLLECTION_FIELDS)
+
+    yield "select_collection", select_collection(fields, ["anime_collections.user_id = ?"], paged=True)
+    yield "select_collection after", select_collection(fields, ["anime_collections.user_id = ?",
+                                                                "anime_collections.release_id > ?"], paged=True)
+    yield "select_collection release", select_collection(fields, ["anime_collections.user_id = ?",
+                                                                  "anime_collections.release_id = ?"])
+    yield "select_existing", select_existing(2)
+    yield "select_anime_ids", select_anime_ids(2)
+    yield "update_collection_fields", update_collection_fields(["price_bought", "comment"])
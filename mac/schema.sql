@@ -1,3 +1,12 @@
+-- Migrations in the "migrations" folder are applied on top of this schema
+PRAGMA user_version = 0;
+
+DROP TABLE IF EXISTS anime_titles;
+DROP TABLE IF EXISTS release_titles;
+-- Tables created by migrations
+DROP TABLE IF EXISTS release_fetches;
+DROP TABLE IF EXISTS collection_stats;
+DROP TABLE IF EXISTS api_tokens;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS anime_shows;
 DROP TABLE IF EXISTS anime_releases;
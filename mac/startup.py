@@ -0,0 +1,112 @@
+import os
+import sys
+import time
+
+import click
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache
+
+# Run in a new process by "flask benchmark-startup", which serves one request
+# with a freshly created application and reports when it is done
+FIRST_REQUEST = """
+import sys
+from mac import create_app
+response = create_app().test_client().get(sys.argv[1])
+print(response.status_code, flush=True)
+"""
+
+
+@click.command("compile-templates")
+def compile_templates_command():
+    """Compile every template into the bytecode cache, so that no process has
+    to compile them when it serves its first pages.
+    """
+
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException("TEMPLATE_BYTECODE_CACHE is turned off.")
+
+    templates = current_app.jinja_env.list_templates()
+
+    for name in templates:
+        current_app.jinja_env.get_template(name)
+
+    click.echo(f"Compiled {len(templates)} templates.")
+
+
+def parse_import_times(output):
+    """Return the modules imported directly by a process run with
+    "python -X importtime", with the milliseconds each took including the
+    modules it imported in turn, slowest first.
+    """
+
+    modules = []
+
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+
+        # Modules imported by other modules are indented
+        if not name.startswith("  "):
+            modules.append((int(cumulative) / 1000, name.strip()))
+
+    return sorted(modules, reverse=True)
+
+
+@click.command("benchmark-startup")
+@click.option("--runs", default=5, help="Number of processes started.")
+@click.option("--path", default="/auth/login", help="Path requested by each process.")
+@click.option("--top", default=10, help="Number of slowest imports listed.")
+def benchmark_startup_command(runs, path, top):
+    """Report how long a new process takes to start, create the application,
+    and serve its first request, and which imports take the longest.
+    """
+
+    # Only loaded for this command, so that other commands and the web server don't pay for them
+    import statistics
+    import subprocess
+
+    # Let the new processes import this package from wherever it is
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join(filter(None, [os.path.dirname(current_app.root_path),
+                                                              environment.get("PYTHONPATH")]))
+
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+
+        process = subprocess.Popen([sys.executable, "-X", "importtime", "-c", FIRST_REQUEST, path],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=environment)
+
+        # Stop timing once the response has been served, before the process exits
+        status = process.stdout.readline().strip()
+        timings.append((time.perf_counter() - start) * 1000)
+
+        _, output = process.communicate()
+
+        if process.returncode or not status:
+            raise click.ClickException(f"The application could not serve {path}:\n{output[-2000:]}")
+
+    click.echo(f"First response ({status}) after {statistics.median(timings):.0f} ms "
+               f"(median of {runs}, fastest {min(timings):.0f} ms, slowest {max(timings):.0f} ms).")
+    click.echo("Slowest imports:")
+
+    for milliseconds, name in parse_import_times(output)[:top]:
+        click.echo(f"{milliseconds:8.1f} ms  {name}")
+
+
+def initialize_app(app):
+    """Cache compiled templates if the TEMPLATE_BYTECODE_CACHE config is set,
+    and register the startup commands with the application instance.
+    """
+
+    if app.config["TEMPLATE_BYTECODE_CACHE"]:
+        directory = os.path.join(app.instance_path, "template-cache")
+        os.makedirs(directory, exist_ok=True)
+
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+    app.cli.add_command(compile_templates_command)
+    app.cli.add_command(benchmark_startup_command)
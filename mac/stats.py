@@ -0,0 +1,70 @@
+import click
+from flask import Blueprint, g, jsonify
+
+from mac import queries
+from mac.auth import login_required
+from mac.db import get_database
+
+# Create "stats" blueprint, whose commands are called directly as "flask <command>"
+blueprint = Blueprint("stats", __name__, cli_group=None)
+
+# Ways collections are broken down in collection_stats, mapped to the SQL
+# expression grouping releases by them. Releases missing a value are grouped under ""
+DIMENSIONS = {
+    "total": "''",
+    "disc_type": "disc_type",
+    "edition": "edition",
+    "store": "COALESCE(store_bought, '')",
+    "month": "COALESCE(substr(date_bought, 1, 7), '')",
+}
+
+
+@blueprint.route("/stats")
+@login_required
+def stats():
+    """Return how many releases are in the user's collection and how much was
+    spent on them, in total and by disc type, edition, store, and month bought.
+    """
+
+    rows = get_database().execute(queries.SELECT_COLLECTION_STATS, [g.user["user_id"]]).fetchall()
+
+    result = {"total": {"items": 0, "spend": 0}}
+
+    for dimension in DIMENSIONS:
+        if dimension != "total":
+            result[dimension] = []
+
+    for row in rows:
+        if row["dimension"] == "total":
+            result["total"] = {"items": row["items"], "spend": row["spend"]}
+        else:
+            result[row["dimension"]].append({"value": row["value"] or None,
+                                             "items": row["items"],
+                                             "spend": row["spend"]})
+
+    # Show months in the order they happened
+    result["month"].sort(key=lambda month: month["value"] or "")
+
+    return jsonify(result)
+
+
+def rebuild_stats(database):
+    """Recompute every user's collection_stats from their collection."""
+
+    with database:
+        database.execute("DELETE FROM collection_stats")
+
+        for dimension, expression in DIMENSIONS.items():
+            database.execute("INSERT INTO collection_stats (user_id, dimension, value, items, spend) "
+                             f"SELECT user_id, ?, {expression}, COUNT(*), TOTAL(price_bought) "
+                             "FROM anime_collections JOIN anime_releases USING (release_id, anime_id) "
+                             f"GROUP BY user_id, {expression}",
+                             [dimension])
+
+
+@blueprint.cli.command("rebuild-stats")
+def rebuild_stats_command():
+    """Recompute collection statistics from scratch."""
+
+    rebuild_stats(get_database())
+    click.echo("Rebuilt collection statistics.")
@@ -0,0 +1,250 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
+import os
+import threading
+
+import click
+from flask import Blueprint, current_app, send_file
+from werkzeug.exceptions import abort
+
+from mac import queries
+from mac.auth import user_not_needed
+from mac.db import get_database
+
+# Create "thumbnails" blueprint, whose commands are called directly as "flask <command>"
+blueprint = Blueprint("thumbnails", __name__, cli_group=None)
+
+# Only one thread at a time should evict thumbnails from the cache, or update its size
+eviction_lock = threading.Lock()
+
+# Bytes of images in each cache folder, as counted by the last eviction plus
+# the images this process has stored since, so that evicting only needs to
+# look through the cache once it may have grown past its configured size
+cache_sizes = {}
+
+
+def get_path(*parts):
+    """Return the path of a file in the thumbnail cache, in the instance folder.
+    Images are stored under "images", named after the SHA-256 of their contents,
+    and files under "releases" hold the name of each release's image.
+    """
+
+    return os.path.join(current_app.instance_path, "thumbnails", *parts)
+
+
+def get_image_path(digest):
+    """Return the path of the cached image whose contents hash to ``digest``."""
+
+    return get_path("images", digest[:2], f"{digest}.jpg")
+
+
+def write_file(path, data):
+    """Write ``data`` to ``path`` atomically, so readers never see half a file."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temporary = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    with open(temporary, "wb") as file:
+        file.write(data)
+
+    os.replace(temporary, path)
+
+
+def lookup(release_id):
+    """Return the digest of a release's cached image, or None if it is not cached.
+    Marks the image as recently used, so that it is evicted last.
+    """
+
+    try:
+        with open(get_path("releases", str(release_id))) as file:
+            digest = file.read()
+
+        os.utime(get_image_path(digest))
+    except FileNotFoundError:
+        return None
+
+    return digest
+
+
+def resize(image):
+    """Shrink an image to the size thumbnails are displayed at. Images are kept
+    as they are if Pillow is not installed, or can't read them.
+    """
+
+    # Pillow is only needed to resize thumbnails, and only loaded once an image is
+    # downloaded. Images are cached as-is without it
+    try:
+        from PIL import Image
+    except ImportError:
+        return image
+
+    output = io.BytesIO()
+
+    try:
+        with Image.open(io.BytesIO(image)) as picture:
+            picture.thumbnail(current_app.config["THUMBNAIL_SIZE"])
+            picture.convert("RGB").save(output, "JPEG", quality=85, optimize=True)
+    except OSError:
+        return image
+
+    return output.getvalue()
+
+
+def store(release_id, image):
+    """Add a release's image to the cache, and return its digest."""
+
+    image = resize(image)
+    digest = hashlib.sha256(image).hexdigest()
+
+    # Releases with the same image share one file
+    if not os.path.exists(get_image_path(digest)):
+        write_file(get_image_path(digest), image)
+
+        with eviction_lock:
+            if get_path("images") in cache_sizes:
+                cache_sizes[get_path("images")] += len(image)
+
+    write_file(get_path("releases", str(release_id)), digest.encode())
+
+    return digest
+
+
+def evict():
+    """Delete the least recently used images until the cache fits in its
+    configured size. Does nothing if the cache is known to fit already.
+    Images stored by other processes are only counted once the cache is looked
+    through again, which happens as soon as this process's count goes over.
+    """
+
+    with eviction_lock:
+        size = cache_sizes.get(get_path("images"))
+
+        if size is not None and size <= current_app.config["THUMBNAIL_CACHE_SIZE"]:
+            return
+
+        images = []
+
+        for directory, _, files in os.walk(get_path("images")):
+            for name in files:
+                path = os.path.join(directory, name)
+
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+                images.append((status.st_mtime, status.st_size, path))
+
+        size = sum(image[1] for image in images)
+
+        # Start with the images that were used the longest time ago. Release files
+        # pointing at a deleted image are treated as not cached
+        for _, image_size, path in sorted(images):
+            if size <= current_app.config["THUMBNAIL_CACHE_SIZE"]:
+                break
+
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+            size -= image_size
+
+        cache_sizes[get_path("images")] = size
+
+
+def cache_thumbnail(database, release_id):
+    """Return the digest of a release's cached image, downloading it from ANN
+    first if needed. Returns None if the release is not in the database.
+    """
+
+    digest = lookup(release_id)
+
+    if digest is not None:
+        return digest
+
+    from mac import ann
+
+    release = database.execute(queries.SELECT_RELEASE_IMAGE, [release_id]).fetchone()
+
+    if release is None or not release["image"]:
+        return None
+
+    digest = store(release_id, ann.fetch_image(release["image"]))
+    evict()
+
+    return digest
+
+
+@blueprint.route("/thumb/<int:release_id>")
+@user_not_needed
+def thumbnail(release_id):
+    """Serve a release's image from the local cache, so that pages don't load
+    every image from ANN.
+    """
+
+    # Another request or process may evict the image at any time, so it is opened
+    # before it is sent, and cached again if it was evicted in the meantime
+    for _ in range(2):
+        # Only look up the release in the database if its image isn't cached yet
+        digest = lookup(release_id)
+
+        if digest is None:
+            from mac import ann
+
+            try:
+                digest = cache_thumbnail(get_database(), release_id)
+            except ann.FetchError:
+                abort(502)
+
+        if digest is None:
+            abort(404)
+
+        try:
+            image = open(get_image_path(digest), "rb")
+        except FileNotFoundError:
+            continue
+
+        # The digest changes whenever the image does, so it is used as the ETag
+        return send_file(image, mimetype="image/jpeg", etag=digest,
+                         max_age=current_app.config["THUMBNAIL_MAX_AGE"], conditional=True)
+
+    # The image was evicted again as soon as it was cached
+    abort(404)
+
+
+@blueprint.cli.command("prefetch-thumbnails")
+def prefetch_thumbnails_command():
+    """Cache the image of every release in any user's collection."""
+
+    from mac import ann
+
+    releases = [release for release in get_database().execute(
+        "SELECT DISTINCT anime_releases.release_id, image "
+        "FROM anime_collections "
+        "JOIN anime_releases ON anime_releases.release_id = anime_collections.release_id "
+        "AND anime_releases.anime_id = anime_collections.anime_id "
+        "WHERE image IS NOT NULL"
+    ) if lookup(release["release_id"]) is None]
+
+    settings = ann.get_settings()
+    cached = 0
+
+    def download(release):
+        try:
+            return release["release_id"], ann.get(release["image"], settings)
+        except ann.FetchError as error:
+            click.echo(f"Could not download image of release {release['release_id']}: {error}")
+            return release["release_id"], None
+
+    # Download images concurrently, but store them one at a time
+    with ThreadPoolExecutor(max_workers=settings["concurrency"]) as executor:
+        for release_id, image in executor.map(download, releases):
+            if image is not None:
+                store(release_id, image)
+                cached += 1
+
+    evict()
+    click.echo(f"Cached {cached} of {len(releases)} uncached images.")
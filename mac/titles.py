@@ -0,0 +1,63 @@
+import re
+
+# A release's disc type is inside the last pair of parentheses in its title,
+# for example "Cowboy Bebop Complete Series (Blu-ray)"
+DISC_TYPE = re.compile(r"\(([^)]+)")
+
+# Disc type of releases whose title doesn't say what it is
+UNKNOWN_DISC_TYPE = "Unknown"
+
+# Editions as they are spelled in ANN titles, mapped to how they are displayed.
+# Editions not in this table are displayed capitalized
+EDITIONS = {
+    "anniversary": "Anniversary",
+    "collector's": "Collector's",
+    "collector’s": "Collector's",
+    "collectors": "Collector's",
+    "complete": "Complete",
+    "deluxe": "Deluxe",
+    "limited": "Limited",
+    "premium": "Premium",
+    "special": "Special",
+    "steelbook": "Steelbook",
+    "ultimate": "Ultimate",
+}
+
+
+def parse_title(title):
+    """Get a release's disc type and edition from its title. Releases that
+    are not any kind of special edition are "Standard".
+    """
+
+    # Use the last parenthesized part of the title that isn't the edition, such
+    # as in "Evangelion 1.11 (DVD) (Special Edition)"
+    disc_type = UNKNOWN_DISC_TYPE
+
+    for part in reversed(DISC_TYPE.findall(title)):
+        if "edition" not in part.lower():
+            disc_type = part
+            break
+
+    # A release's edition is the word right before "Edition" in its title, for
+    # example "Cowboy Bebop [Collector's Edition] (Blu-ray)"
+    lowered = title.lower()
+    position = lowered.find("edition")
+
+    if position == -1:
+        return disc_type, "Standard"
+
+    words = lowered[:position].split()
+
+    # Remove anything before the word that isn't a letter, such as an opening bracket
+    word = words[-1].lstrip("([{-/\"'") if words else ""
+
+    if not word:
+        return disc_type, "Standard"
+
+    return disc_type, EDITIONS.get(word, word.capitalize())
+
+
+def parse_titles(titles):
+    """Get the disc type and edition of each title in ``titles``."""
+
+    return [parse_title(title) for title in titles]
@@ -0,0 +1,215 @@
+import bisect
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+from flask import current_app
+
+from mac.db import catalog_version, get_database
+
+# Only one thread at a time should reload the snapshot
+lock = threading.Lock()
+
+# The snapshot starts with this header: a marker of the file's format, then the
+# number of anime, title entries, and word entries it holds
+HEADER = struct.Struct("<8s3I")
+MAGIC = b"MACSNAP1"
+
+# Each anime is stored as its anime_id, followed by the offsets and lengths of
+# its title, precision, and casefolded title in the strings that end the file
+ANIME = struct.Struct("<7I")
+
+# Each index entry is the anime it belongs to, and how far into that anime's
+# casefolded title its key starts
+ENTRY = struct.Struct("<2I")
+
+
+def get_snapshot_path():
+    """Return the path of the catalog snapshot shared by every process."""
+
+    return os.path.join(current_app.instance_path, "catalog.snapshot")
+
+
+def write_snapshot(database):
+    """Write the titles in anime_shows to the catalog snapshot, a file that
+    every process maps into memory instead of building its own index. Titles
+    are indexed twice: once keyed by the whole title, and once keyed by every
+    word they contain onwards, so that typing any word of a title finds it.
+    """
+
+    anime = []
+    titles = []
+    words = []
+    strings = bytearray()
+
+    for number, (anime_id, title, precision) in enumerate(
+            database.execute("SELECT anime_id, title, precision FROM anime_shows ORDER BY anime_id")):
+        key = title.casefold()
+        encoded = {}
+
+        for name, value in (("title", title), ("precision", precision), ("key", key)):
+            encoded[name] = (len(strings), len(value.encode()))
+            strings += value.encode()
+
+        anime.append((anime_id, *encoded["title"], *encoded["precision"], *encoded["key"]))
+
+        # Keys are compared as UTF-8, which sorts the same way as the strings themselves
+        titles.append((key.encode(), anime_id, number, 0))
+
+        # Index the title from the start of each of its words, besides the first
+        for position in range(1, len(key)):
+            if key[position].isalnum() and not key[position - 1].isalnum():
+                words.append((key[position:].encode(), anime_id, number, len(key[:position].encode())))
+
+    # Sort both indexes so that titles starting with a prefix can be found with a binary search
+    titles.sort()
+    words.sort()
+
+    path = get_snapshot_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Write to a temporary file first, then put it in place in one step, so
+    # that processes never map a snapshot that is only partly written
+    file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix="catalog.", delete=False)
+
+    try:
+        with file:
+            file.write(HEADER.pack(MAGIC, len(anime), len(titles), len(words)))
+
+            for row in anime:
+                file.write(ANIME.pack(*row))
+
+            for entries in (titles, words):
+                for _, _, number, start in entries:
+                    file.write(ENTRY.pack(number, start))
+
+            file.write(strings)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(file.name, path)
+    except BaseException:
+        os.remove(file.name)
+        raise
+
+
+class Entries:
+    """Sequence of the keys in one of the snapshot's indexes, read from the
+    mapped file as they are needed, so that it can be searched with bisect.
+    """
+
+    def __init__(self, snapshot, offset, length):
+        self.snapshot = snapshot
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, position):
+        number, start = ENTRY.unpack_from(self.snapshot.data, self.offset + position * ENTRY.size)
+        key_offset, key_length = self.snapshot.get_anime(number)[5:]
+
+        return self.snapshot.get_string(key_offset + start, key_length - start)
+
+    def get_anime(self, position):
+        """Return the anime that the entry at ``position`` belongs to."""
+
+        number, _ = ENTRY.unpack_from(self.snapshot.data, self.offset + position * ENTRY.size)
+
+        return self.snapshot.get_anime(number)
+
+
+class Snapshot:
+    """Catalog snapshot mapped into memory. The operating system shares its
+    pages between every process that maps the same file.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.count, title_count, word_count = HEADER.unpack_from(self.data)
+
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a catalog snapshot.")
+
+        titles_offset = HEADER.size + self.count * ANIME.size
+        words_offset = titles_offset + title_count * ENTRY.size
+
+        self.titles = Entries(self, titles_offset, title_count)
+        self.words = Entries(self, words_offset, word_count)
+        self.strings_offset = words_offset + word_count * ENTRY.size
+
+    def get_anime(self, number):
+        """Return the fields stored for the ``number``th anime."""
+
+        return ANIME.unpack_from(self.data, HEADER.size + number * ANIME.size)
+
+    def get_string(self, offset, length):
+        """Return the encoded string at ``offset`` in the snapshot's strings."""
+
+        offset += self.strings_offset
+
+        return self.data[offset:offset + length]
+
+
+def get_snapshot():
+    """Return the catalog snapshot, mapping it on first use and again whenever
+    the catalog has changed. Writes the snapshot first if there is none yet.
+    """
+
+    version = catalog_version()
+    snapshot = current_app.extensions.get("typeahead")
+
+    if snapshot is None or snapshot[0] != version:
+        with lock:
+            # Another thread may have reloaded the snapshot while this one was waiting
+            snapshot = current_app.extensions.get("typeahead")
+
+            if snapshot is None or snapshot[0] != version:
+                path = get_snapshot_path()
+
+                if not os.path.exists(path):
+                    write_snapshot(get_database())
+
+                # Requests still using the previous snapshot keep it mapped until they are done
+                snapshot = (version, Snapshot(path))
+                current_app.extensions["typeahead"] = snapshot
+
+    return snapshot[1]
+
+
+def complete(prefix, limit):
+    """Return up to ``limit`` anime whose title, or any word in their title,
+    starts with ``prefix``. Matches on the start of the title come first.
+    """
+
+    snapshot = get_snapshot()
+    prefix = prefix.casefold().encode()
+    matches = {}
+
+    for entries in (snapshot.titles, snapshot.words):
+        # Find the first entry that could start with the prefix, then walk forward
+        position = bisect.bisect_left(entries, prefix)
+
+        while position < len(entries) and len(matches) < limit:
+            if not entries[position].startswith(prefix):
+                break
+
+            # The same anime can be indexed under several of its words
+            anime_id, title_offset, title_length, precision_offset, precision_length, _, _ = \
+                entries.get_anime(position)
+
+            if anime_id not in matches:
+                matches[anime_id] = {
+                    "anime_id": anime_id,
+                    "title": snapshot.get_string(title_offset, title_length).decode(),
+                    "precision": snapshot.get_string(precision_offset, precision_length).decode(),
+                }
+
+            position += 1
+
+    return list(matches.values())
@@ -0,0 +1,256 @@
+import os
+import threading
+import time
+
+import click
+from flask import current_app
+
+from mac.collection import parse_releases, store_releases
+from mac.db import get_database
+
+
+def next_batch(database, size):
+    """Get the ids of the next anime whose releases have never been fetched,
+    starting with the anime that are in the most users' collections.
+    """
+
+    return [row["anime_id"] for row in database.execute(
+        "SELECT anime_shows.anime_id "
+        "FROM anime_shows "
+        "LEFT JOIN (SELECT anime_id, COUNT(*) AS collected FROM anime_collections GROUP BY anime_id) AS counts "
+        "ON counts.anime_id = anime_shows.anime_id "
+        "WHERE anime_shows.anime_id NOT IN (SELECT anime_id FROM release_fetches) "
+        "ORDER BY COALESCE(counts.collected, 0) DESC, anime_shows.anime_id "
+        "LIMIT ?",
+        [size]
+    )]
+
+
+def warm_releases(database, limit=None, rate=None, report=None):
+    """Fetch releases from ANN for anime that haven't been fetched yet, one
+    batch at a time, so that no user has to wait on ANN on the details page.
+    Anime already fetched are skipped, so stopping and rerunning resumes where
+    the last run stopped. Returns how many anime were fetched.
+    """
+
+    from mac import ann
+
+    batch_size = current_app.config["ANN_BATCH_SIZE"]
+    rate = rate or current_app.config["WARM_RELEASES_RATE"]
+
+    # Keep track of how many anime still need fetching, and how many were fetched
+    remaining = database.execute("SELECT COUNT(*) FROM anime_shows "
+                                 "WHERE anime_id NOT IN (SELECT anime_id FROM release_fetches)").fetchone()[0]
+    fetched = 0
+
+    if limit is not None:
+        remaining = min(remaining, limit)
+
+    while fetched < remaining:
+        start = time.monotonic()
+
+        batch = next_batch(database, min(batch_size, remaining - fetched))
+
+        if not batch:
+            break
+
+        # Fetch and store the whole batch's releases at once
+        anime = ann.fetch_anime(batch)
+        releases = []
+
+        for anime_id in batch:
+            if anime_id in anime:
+                releases.extend(parse_releases(anime[anime_id], anime_id))
+
+        store_releases(database, batch, releases)
+        fetched += len(batch)
+
+        if report is not None:
+            report(f"Fetched releases for {fetched}/{remaining} anime ({len(releases)} releases in last batch).")
+
+        # Wait so that ANN is called at most "rate" times per second
+        time.sleep(max(0, 1 / rate - (time.monotonic() - start)))
+
+    return fetched
+
+
+@click.command("warm-releases")
+@click.option("--limit", type=int, help="Stop after fetching this many anime.")
+@click.option("--rate", type=float, help="Maximum calls to ANN per second.")
+def warm_releases_command(limit, rate):
+    """Fetch releases from ANN ahead of users opening each anime's details page."""
+
+    fetched = warm_releases(get_database(), limit, rate, click.echo)
+    click.echo(f"Fetched releases for {fetched} anime.")
+
+
+def list_dumps(path):
+    """Yield the path of every XML file in ``path``, or ``path`` itself if it is a file."""
+
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for directory, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.endswith(".xml"):
+                yield os.path.join(directory, name)
+
+
+def parse_dump(path):
+    """Parse the releases of every anime in a saved ANN API response. Runs in a
+    worker process, so errors are returned instead of raised.
+    """
+
+    import xml.etree.ElementTree as ET
+
+    try:
+        root = ET.parse(path).getroot()
+    except (OSError, ET.ParseError) as error:
+        return path, [], str(error)
+
+    anime = []
+
+    for element in root.findall("anime"):
+        anime_id = int(element.get("id"))
+        anime.append((anime_id, parse_releases(element, anime_id)))
+
+    return path, anime, None
+
+
+def import_releases(database, path, processes=None, report=None):
+    """Load releases from saved ANN API responses into anime_releases, parsing
+    the files in parallel and storing them in batched transactions. Returns
+    how many anime had their releases imported.
+    """
+
+    batch_size = current_app.config["IMPORT_BATCH_SIZE"]
+    imported = 0
+    batch = []
+
+    def store(batch):
+        # Skip anime that are not in the catalog
+        ids = [anime_id for anime_id, _ in batch]
+        known = {row["anime_id"] for row in database.execute(
+            f"SELECT anime_id FROM anime_shows WHERE anime_id IN ({', '.join('?' * len(ids))})", ids
+        )}
+
+        batch = [(anime_id, releases) for anime_id, releases in batch if anime_id in known]
+        store_releases(database, [anime_id for anime_id, _ in batch],
+                       [release for _, releases in batch for release in releases])
+
+        return len(batch)
+
+    import multiprocessing
+
+    with multiprocessing.Pool(processes) as pool:
+        for file, anime, error in pool.imap_unordered(parse_dump, list_dumps(path), chunksize=16):
+            if error is not None:
+                if report is not None:
+                    report(f"Skipped {file}: {error}")
+                continue
+
+            batch.extend(anime)
+
+            # SQLite only allows so many parameters in one query, so also keep batches below that
+            if len(batch) >= min(batch_size, 10000):
+                imported += store(batch)
+                batch.clear()
+
+                if report is not None:
+                    report(f"Imported releases for {imported} anime.")
+
+        if batch:
+            imported += store(batch)
+
+    return imported
+
+
+@click.command("import-releases")
+@click.argument("path", type=click.Path(exists=True))
+@click.option("--processes", type=int, help="Number of processes parsing files. Defaults to one per CPU.")
+def import_releases_command(path, processes):
+    """Load releases from a saved ANN API response, or a directory of them,
+    without calling ANN.
+    """
+
+    imported = import_releases(get_database(), path, processes, click.echo)
+    click.echo(f"Imported releases for {imported} anime.")
+
+
+def acquire_worker_lock(app):
+    """Return True if this process is the one to run the background worker,
+    which holds a lock on a file in the instance folder for as long as it runs.
+    """
+
+    try:
+        import fcntl
+    except ImportError:
+        # Without fcntl, the app is being served by a single process anyway
+        return True
+
+    file = open(os.path.join(app.instance_path, "warm-releases.lock"), "w")
+
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return False
+
+    # The lock is released when the file is closed, so keep it open
+    app.extensions["warm_releases_lock"] = file
+
+    return True
+
+
+def run_worker(app):
+    """Keep fetching releases in the background, checking for newly imported
+    anime once every anime has been fetched.
+    """
+
+    from mac import ann
+
+    # Only one of the server's processes fetches releases. The others keep
+    # checking, so that one of them takes over if that process exits
+    while not acquire_worker_lock(app):
+        time.sleep(app.config["WARM_RELEASES_IDLE"])
+
+    while True:
+        with app.app_context():
+            try:
+                fetched = warm_releases(get_database())
+            except ann.FetchError as error:
+                app.logger.warning("Could not warm releases: %s", error)
+                fetched = 0
+            # Keep the worker running through anything else, such as the database being locked
+            except Exception:
+                app.logger.exception("Warming releases failed")
+                fetched = 0
+
+        # Wait before checking again once there is nothing left to fetch
+        if not fetched:
+            time.sleep(app.config["WARM_RELEASES_IDLE"])
+
+
+def initialize_app(app):
+    """Register the warm-releases and import-releases commands, and the
+    background worker if it is enabled in the application's config.
+    """
+
+    app.cli.add_command(warm_releases_command)
+    app.cli.add_command(import_releases_command)
+
+    if not app.config["WARM_RELEASES_IN_BACKGROUND"]:
+        return
+
+    lock = threading.Lock()
+    started = []
+
+    # Start the worker with the first request, so that "flask" commands don't start it
+    @app.before_request
+    def start_worker():
+        if not started:
+            with lock:
+                if not started:
+                    started.append(threading.Thread(target=run_worker, args=[app], daemon=True))
+                    started[0].start()
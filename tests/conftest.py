@@ -0,0 +1,140 @@
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from mac import ann, create_app
+from mac.db import get_database, initialize_database
+
+
+class StubANN:
+    """Stub of the ANN API, which records the requests it gets and answers
+    them with the statuses and delays a test asks for.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        # Statuses to respond with, in order, for each value of the anime parameter
+        self.statuses = {}
+        # Seconds to wait before responding
+        self.delay = 0
+        # Title of each anime's release, if not "Anime <id> (Blu-ray)"
+        self.titles = {}
+
+    def respond(self, handler):
+        ids = urllib.parse.parse_qs(urllib.parse.urlsplit(handler.path).query).get("anime", [""])[0]
+
+        with self.lock:
+            self.requests.append((ids, handler.client_address[1]))
+            statuses = self.statuses.get(ids)
+            status = statuses.pop(0) if statuses else 200
+
+        time.sleep(self.delay)
+
+        body = "".join(f'<anime id="{id}" name="Anime {id}">'
+                       f'<release date="2020-01-01" href="/encyclopedia/releases.php?id={id}0">'
+                       f'{self.titles.get(id, f"Anime {id} (Blu-ray)")}</release></anime>'
+                       for id in ids.split("/") if id)
+        body = f"<ann>{body}</ann>".encode()
+
+        handler.send_response(status)
+        handler.send_header("Content-Type", "text/xml")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+@pytest.fixture
+def stub():
+    """Run a stub ANN API for the duration of a test."""
+
+    stub = StubANN()
+
+    class Handler(BaseHTTPRequestHandler):
+        # Keep connections open between requests, like ANN does
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            stub.respond(self)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stub.url = f"http://127.0.0.1:{server.server_address[1]}/encyclopedia/api.xml"
+
+    yield stub
+
+    server.shutdown()
+    server.server_close()
+
+
+# Catalog imported into every test's database
+CATALOG = """<report>
+<item><id>1</id><type>TV</type><name>Cowboy Bebop</name><precision>Cowboy Bebop (TV)</precision></item>
+<item><id>2</id><type>TV</type><name>Mobile Suit Gundam</name><precision>Mobile Suit Gundam (TV)</precision></item>
+<item><id>3</id><type>movie</type><name>Akira</name><precision>Akira (movie)</precision></item>
+</report>
+"""
+
+
+@pytest.fixture
+def make_app(tmp_path, stub):
+    """Return a function creating an application with an instance folder and
+    database of its own, calling the stub ANN API, with any config given.
+    """
+
+    catalog = tmp_path / "anime-reports.xml"
+    catalog.write_text(CATALOG)
+
+    def make(**config):
+        app = create_app({
+            "TESTING": True,
+            "DATABASE": str(tmp_path / "test.sqlite"),
+            "CATALOG_XML": str(catalog),
+            "ANN_API_URL": stub.url,
+            "ANN_BACKOFF": 0.01,
+            **config,
+        }, instance_path=str(tmp_path / "instance"))
+
+        with app.app_context():
+            initialize_database()
+            get_database().execute("INSERT INTO users (username, password) VALUES ('test', '')")
+            get_database().commit()
+
+        return app
+
+    # The ANN client keeps its semaphore, threads, and connections between requests
+    ann.semaphore = None
+    ann.executor = None
+    ann.close_connection()
+
+    yield make
+
+    ann.close_connection()
+
+    if ann.executor is not None:
+        ann.executor[1].shutdown()
+
+
+@pytest.fixture
+def app(make_app):
+    """Create an application with the default test config."""
+
+    return make_app()
+
+
+@pytest.fixture
+def client(app):
+    """Return a test client logged in as the test user."""
+
+    client = app.test_client()
+
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+
+    return client
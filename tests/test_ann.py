@@ -0,0 +1,132 @@
+import threading
+import time
+
+import pytest
+
+from mac import ann
+
+
+def test_fetch_anime_in_batches(app, stub):
+    app.config["ANN_BATCH_SIZE"] = 2
+
+    with app.app_context():
+        anime = ann.fetch_anime([1, 2, 3, 4, 5])
+
+    assert sorted(anime) == [1, 2, 3, 4, 5]
+    assert sorted(ids for ids, _ in stub.requests) == ["1/2", "3/4", "5"]
+
+
+def test_connection_reused(app, stub):
+    with app.app_context():
+        ann.fetch_anime([1])
+        ann.fetch_anime([2])
+        ann.fetch_anime([3])
+
+    # Every request came from the same client port, so over the same connection
+    assert len(stub.requests) == 3
+    assert len({port for _, port in stub.requests}) == 1
+
+
+@pytest.mark.parametrize("status", [500, 503, 429])
+def test_retry_on_server_error(app, stub, status):
+    stub.statuses["1"] = [status, status]
+
+    with app.app_context():
+        anime = ann.fetch_anime([1])
+
+    assert list(anime) == [1]
+    assert len(stub.requests) == 3
+
+
+@pytest.mark.parametrize("status", [400, 403, 404])
+def test_no_retry_on_client_error(app, stub, status):
+    stub.statuses["1"] = [status]
+
+    with app.app_context(), pytest.raises(ann.FetchError, match=str(status)):
+        ann.fetch_anime([1])
+
+    assert len(stub.requests) == 1
+
+
+def test_give_up_after_retries(app, stub):
+    app.config["ANN_RETRIES"] = 2
+    stub.statuses["1"] = [500] * 5
+
+    with app.app_context(), pytest.raises(ann.FetchError, match="3 attempts"):
+        ann.fetch_anime([1])
+
+    assert len(stub.requests) == 3
+
+
+def test_timeout(app, stub):
+    app.config.update(ANN_TIMEOUT=0.1, ANN_RETRIES=0)
+    stub.delay = 1
+
+    start = time.monotonic()
+
+    with app.app_context(), pytest.raises(ann.FetchError):
+        ann.fetch_anime([1])
+
+    assert time.monotonic() - start < 0.5
+
+
+def test_deadline_includes_retries(app, stub):
+    app.config.update(ANN_TIMEOUT=0.2, ANN_RETRIES=10, ANN_DEADLINE=0.5)
+    stub.delay = 1
+
+    start = time.monotonic()
+
+    with app.app_context(), pytest.raises(ann.FetchError):
+        ann.fetch_anime([1])
+
+    assert time.monotonic() - start < 0.8
+
+
+def test_backoff_does_not_hold_concurrency_slot(app, stub):
+    app.config.update(ANN_CONCURRENCY=1, ANN_RETRIES=1, ANN_BACKOFF=1)
+    stub.statuses["1"] = [500, 500]
+    errors = []
+
+    def fetch_failing():
+        with app.app_context():
+            try:
+                ann.fetch_anime([1])
+            except ann.FetchError as error:
+                errors.append(error)
+
+    thread = threading.Thread(target=fetch_failing)
+    thread.start()
+
+    # Wait until the first attempt has failed, and the thread is backing off
+    while not stub.requests:
+        time.sleep(0.01)
+
+    start = time.monotonic()
+
+    with app.app_context():
+        anime = ann.fetch_anime([2])
+
+    assert list(anime) == [2]
+    assert time.monotonic() - start < 0.5
+
+    thread.join()
+    assert len(errors) == 1
+
+
+def test_fetch_no_anime(app, stub):
+    with app.app_context():
+        assert ann.fetch_anime([]) == {}
+
+    assert stub.requests == []
+
+
+def test_batch_connections_reused_between_calls(app, stub):
+    app.config.update(ANN_BATCH_SIZE=1, ANN_CONCURRENCY=2)
+
+    with app.app_context():
+        for _ in range(5):
+            assert sorted(ann.fetch_anime([1, 2, 3, 4])) == [1, 2, 3, 4]
+
+    # The same threads, and so the same connections, request every batch
+    assert len(stub.requests) == 20
+    assert len({port for _, port in stub.requests}) <= 2
@@ -0,0 +1,129 @@
+import io
+import json
+
+import pytest
+
+from mac import bulk
+from mac.db import get_database
+
+RELEASES = [
+    (10, "Cowboy Bebop Complete Series (Blu-ray)"),
+    (11, "Cowboy Bebop Complete Series [Collector's Edition] (Blu-ray)"),
+    (12, "Cowboy Bebop: The Movie (DVD)"),
+    (13, "Trigun Complete Series (Blu-ray)"),
+]
+
+
+def add_releases(app):
+    with app.app_context():
+        database = get_database()
+        database.executemany("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, release_date) "
+                             "VALUES (?, 1, ?, 'Blu-ray', '2020-01-01')",
+                             RELEASES)
+        database.commit()
+
+
+def import_file(client, text):
+    return client.post("/collection/import",
+                       data={"file": (io.BytesIO(text.encode()), "collection.csv")},
+                       content_type="multipart/form-data")
+
+
+def test_import_matches_titles(app, client):
+    add_releases(app)
+
+    response = import_file(client, "release_title,price_bought\n"
+                                   "Cowboy Bebop: The Movie (DVD),10\n"
+                                   "Cowboy Bebop Complete Series [Collectors Edition] (Blu-ray),20\n"
+                                   "Trigun Complete Sries (Blu-ray),30\n"
+                                   "Nothing Like It,40\n")
+
+    assert response.get_json()["imported"] == 3
+    assert [error["row"] for error in response.get_json()["errors"]] == [4]
+
+    with app.app_context():
+        collection = get_database().execute("SELECT release_id, price_bought FROM anime_collections "
+                                            "ORDER BY release_id").fetchall()
+
+    assert [tuple(row) for row in collection] == [(11, 20), (12, 10), (13, 30)]
+
+
+def test_import_keeps_rows_read_before_unreadable_line(app, client):
+    add_releases(app)
+    app.config["IMPORT_BATCH_SIZE"] = 2
+
+    # Cache the empty collection page
+    assert b"Cowboy Bebop" not in client.get("/").data
+
+    # The last line's field is too long for the CSV reader
+    response = import_file(client, "release_id,comment\n10,\n11,\n12,\n" + "13," + "x" * 200000 + "\n")
+
+    assert response.status_code == 400
+    assert response.get_json()["imported"] == 3
+    assert "Could not read file" in response.get_json()["error"]
+
+    # The cached page was dropped, as the collection changed
+    assert client.get("/").data.count(b"Cowboy Bebop") == 3
+
+
+def test_updated_release_titles_are_matched(app, client):
+    add_releases(app)
+
+    # Releases are stored again with new titles when they are refreshed from ANN
+    with app.app_context():
+        database = get_database()
+        database.execute("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, release_date) "
+                         "VALUES (13, 1, 'Trigun Remastered (Blu-ray)', 'Blu-ray', '2020-01-01') "
+                         "ON CONFLICT (release_id, anime_id) DO UPDATE SET release_title = excluded.release_title")
+        database.commit()
+
+    response = import_file(client, "release_title\nTrigun Remastred (Blu-ray)\n")
+
+    assert response.get_json()["imported"] == 1
+
+
+def test_import_stops_at_json_row_that_is_not_an_object(app, client):
+    add_releases(app)
+
+    response = client.post("/collection/import",
+                           data={"file": (io.BytesIO(b'[{"release_id": 10}, {"release_id": 11}, [12]]'),
+                                          "collection.json")},
+                           content_type="multipart/form-data")
+
+    assert response.status_code == 400
+    assert response.get_json()["error"] == "Could not read file: Row 3 is not an object."
+    assert response.get_json()["imported"] == 2
+
+
+def test_import_does_not_hide_errors_in_matching(app, client, monkeypatch):
+    def broken_match(database, row):
+        raise AttributeError("broken")
+
+    monkeypatch.setattr(bulk, "match_release", broken_match)
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+
+    assert import_file(client, "release_id\n10\n").status_code == 500
+
+
+def test_json_is_read_a_chunk_at_a_time(monkeypatch):
+    monkeypatch.setattr(bulk, "JSON_CHUNK_SIZE", 16)
+    file = io.StringIO(json.dumps([{"release_id": number} for number in range(100)]))
+    rows = bulk.read_rows(file, "json")
+
+    assert next(rows) == {"release_id": "0"}
+    assert file.tell() <= 32
+    assert [row["release_id"] for row in rows] == [str(number) for number in range(1, 100)]
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] ", "[1, 2 ,3]", '[{"a": "x,]y"}, {"b": [1, 2]}]', "[12345678]"])
+@pytest.mark.parametrize("chunk_size", [1, 3, 100])
+def test_json_items_split_across_chunks(monkeypatch, text, chunk_size):
+    monkeypatch.setattr(bulk, "JSON_CHUNK_SIZE", chunk_size)
+
+    assert list(bulk.iterate_json(io.StringIO(text))) == json.loads(text)
+
+
+@pytest.mark.parametrize("text", ["", "{}", "[1,", "[1 2]", "[1", "[,1]"])
+def test_json_that_is_not_an_array(text):
+    with pytest.raises(json.JSONDecodeError):
+        list(bulk.iterate_json(io.StringIO(text)))
@@ -0,0 +1,49 @@
+import pytest
+
+from mac import collection
+from mac.db import get_database, initialize_database
+
+
+@pytest.mark.parametrize("backend", ["memory", "filesystem"])
+def test_initializing_database_drops_cached_pages(app, client, backend):
+    app.config["PAGE_CACHE"] = backend
+
+    with app.app_context():
+        database = get_database()
+        database.execute("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, release_date) "
+                         "VALUES (10, 1, 'Cowboy Bebop (DVD)', 'DVD', '2020-01-01')")
+        database.execute("INSERT INTO anime_collections (user_id, anime_id, release_id, comment) "
+                         "VALUES (1, 1, 10, 'Secret comment')")
+        database.commit()
+
+    response = client.get("/")
+    assert b"Secret comment" in response.data
+    assert b"test" in response.data
+
+    # A new user gets the id the old one had
+    with app.app_context():
+        initialize_database()
+        get_database().execute("INSERT INTO users (username, password) VALUES ('other', '')")
+        get_database().commit()
+
+    response = client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+    assert response.status_code == 200
+    assert b"Secret comment" not in response.data
+    assert b"other" in response.data
+
+
+def test_refreshed_releases_change_cached_page(app, client, stub):
+    client.get("/1/details")
+    client.get("/add?release_id=10&anime_id=1")
+
+    response = client.get("/")
+    assert b"Anime 1 (Blu-ray)" in response.data
+
+    # ANN now has a different title for the release
+    stub.titles["1"] = "Anime 1 (DVD)"
+    collection.refresh_anime_data(app, 1)
+
+    refreshed = client.get("/", headers={"If-None-Match": response.headers["ETag"]})
+    assert refreshed.status_code == 200
+    assert refreshed.headers["ETag"] != response.headers["ETag"]
+    assert b"Anime 1 (DVD)" in refreshed.data
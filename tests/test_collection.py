@@ -0,0 +1,57 @@
+import pytest
+
+from mac import bulk
+from mac.db import get_database
+
+
+def add_release(app, client):
+    with app.app_context():
+        database = get_database()
+        database.execute("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, release_date) "
+                         "VALUES (10, 1, 'Cowboy Bebop (DVD)', 'DVD', '2020-01-01')")
+        database.commit()
+
+    client.get("/add?release_id=10&anime_id=1")
+
+
+def date_bought(app):
+    with app.app_context():
+        return get_database().execute("SELECT date_bought FROM anime_collections WHERE release_id = 10").fetchone()[0]
+
+
+def test_edit_stores_date(app, client):
+    add_release(app, client)
+
+    response = client.post("/10/edit", data={"price-bought": "20", "date-bought": "2021-03-04"})
+
+    assert response.status_code == 302
+    assert date_bought(app) == "2021-03-04"
+    assert b"03/04/2021" in client.get("/").data
+
+
+@pytest.mark.parametrize("date", ["03/04/2021", "2021-13-01", "yesterday"])
+def test_edit_rejects_invalid_date(app, client, date):
+    add_release(app, client)
+
+    response = client.post("/10/edit", data={"price-bought": "20", "date-bought": date})
+
+    assert response.status_code == 200
+    assert b"is not a date." in response.data
+    assert date_bought(app) is None
+
+
+@pytest.mark.parametrize("date, stored", [
+    ("2021-03-04", "2021-03-04"),
+    ("3/4/2021", "2021-03-04"),
+    (" 03/04/2021 ", "2021-03-04"),
+    ("", None),
+    (None, None),
+])
+def test_import_parses_dates(date, stored):
+    assert bulk.parse_date(date) == stored
+
+
+@pytest.mark.parametrize("date", ["2021/03/04", "13/01/2021", "2021-02-30", "soon"])
+def test_import_rejects_invalid_dates(date):
+    with pytest.raises(ValueError, match="is not a date"):
+        bulk.parse_date(date)
@@ -0,0 +1,60 @@
+from xml.etree.ElementTree import ParseError
+
+import pytest
+
+from mac import queries
+from mac.db import get_database, import_xml
+
+
+def test_view_queries_do_not_scan(app):
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=["check-query-plans"])
+
+    assert result.exit_code == 0, result.output
+    assert "None of the" in result.output
+
+
+def test_check_covers_every_collection_page_query():
+    names = [name for name, _ in queries.list_view_queries()]
+
+    # Each sort key and order, with each combination of the 8 filters, with and without paging
+    assert len([name for name in names if name.startswith("index ")]) == 3 * 2 * 2 ** 8 * 2
+    assert "SELECT_EXPORTED_COLLECTION" in names
+    assert "SEARCH_TITLES_WITHOUT_INDEX" not in names
+
+
+def test_sync_catalog_asks_for_migrations_first(app):
+    with app.app_context():
+        database = get_database()
+        database.execute("DROP TABLE release_fetches")
+        database.execute("PRAGMA user_version = 2")
+
+        result = app.test_cli_runner().invoke(args=["sync-catalog"])
+
+    assert result.exit_code == 1
+    assert 'Run "flask migrate" first.' in result.output
+    assert result.exception is None or isinstance(result.exception, SystemExit)
+
+
+def test_sync_catalog(app):
+    with app.app_context():
+        result = app.test_cli_runner().invoke(args=["sync-catalog"])
+
+    assert result.exit_code == 0, result.output
+    assert "0 inserted, 0 updated, 0 deleted" in result.output
+
+
+def test_failed_import_restores_durability_settings(app, tmp_path):
+    catalog = tmp_path / "broken.xml"
+    catalog.write_text("<report><item><id>9</id><type>TV</type><name>Broken")
+    app.config["CATALOG_XML"] = str(catalog)
+
+    with app.app_context():
+        database = get_database()
+
+        with pytest.raises(ParseError):
+            import_xml(database)
+
+        assert database.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        # NORMAL, as every pooled connection is set up with
+        assert database.execute("PRAGMA synchronous").fetchone()[0] == 1
@@ -0,0 +1,88 @@
+import threading
+
+from mac.db import get_database
+
+
+def test_details_fetches_releases_once(client, stub):
+    response = client.get("/1/details")
+
+    assert response.status_code == 200
+    assert b"Anime 1 (Blu-ray)" in response.data
+
+    # The releases are now served from the database
+    assert client.get("/1/details").status_code == 200
+    assert [ids for ids, _ in stub.requests] == ["1"]
+
+
+def test_concurrent_misses_call_ann_once(app, stub):
+    # Keep ANN's response slow enough that every request arrives while it is pending
+    stub.delay = 0.5
+    statuses = []
+    barrier = threading.Barrier(100)
+
+    def request():
+        client = app.test_client()
+
+        with client.session_transaction() as session:
+            session["user_id"] = 1
+
+        barrier.wait()
+        statuses.append(client.get("/2/details").status_code)
+
+    threads = [threading.Thread(target=request) for _ in range(100)]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert statuses == [200] * 100
+    assert [ids for ids, _ in stub.requests] == ["2"]
+
+    with app.app_context():
+        assert get_database().execute("SELECT COUNT(*) FROM anime_releases WHERE anime_id = 2").fetchone()[0] == 1
+
+
+def test_stale_hits_queued_refresh_once(app, client, stub):
+    from mac import collection
+
+    client.get("/1/details")
+    client.get("/3/details")
+
+    # Every stored release is now out of date, and one slow thread refreshes them
+    app.config.update(RELEASES_TTL=-1, RELEASES_REFRESH_WORKERS=1)
+    collection.refresher = None
+    stub.delay = 0.2
+
+    # Keep the refresh thread busy, so that refreshes of anime 3 wait in its queue
+    client.get("/1/details")
+
+    for _ in range(20):
+        client.get("/3/details")
+
+    # Wait for every queued refresh to finish
+    collection.refresher.shutdown(wait=True)
+    collection.refresher = None
+
+    assert [ids for ids, _ in stub.requests] == ["1", "3", "1", "3"]
+
+
+def test_background_refresh_changes_collection_page(app, client, stub):
+    from mac import collection
+
+    client.get("/1/details")
+    client.get("/add?release_id=10&anime_id=1")
+    assert b"Anime 1 (Blu-ray)" in client.get("/").data
+
+    # The stored release is now out of date, and ANN has a new title for it
+    app.config["RELEASES_TTL"] = -1
+    collection.refresher = None
+    stub.titles["1"] = "Anime 1 (DVD)"
+
+    # Showing the stale release schedules its refresh
+    assert b"Anime 1 (Blu-ray)" in client.get("/1/details").data
+
+    collection.refresher.shutdown(wait=True)
+    collection.refresher = None
+
+    assert b"Anime 1 (DVD)" in client.get("/").data
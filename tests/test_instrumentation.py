@@ -0,0 +1,108 @@
+import itertools
+import re
+import types
+
+from flask import g
+import pytest
+
+from mac import instrumentation
+from mac.db import get_database
+
+# Returns ten rows, which SQLite only produces as they are fetched
+TEN_ROWS = ("WITH RECURSIVE numbers (number) AS (SELECT 1 UNION ALL SELECT number + 1 FROM numbers LIMIT 10) "
+            "SELECT number FROM numbers")
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app(INSTRUMENTATION=True)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Make every reading of the instrumentation's clock one second later than
+    the last, so that recorded times count how often it was read.
+    """
+
+    ticks = itertools.count()
+    monkeypatch.setattr(instrumentation, "time", types.SimpleNamespace(perf_counter=lambda: next(ticks)))
+
+
+def test_statement_time_includes_fetching(app, clock):
+    with app.test_request_context():
+        instrumentation.start_request()
+
+        cursor = get_database().execute(TEN_ROWS)
+        [(executed, sql)] = g.statements
+
+        assert sql == TEN_ROWS
+        assert executed == 1
+
+        assert cursor.fetchone()["number"] == 1
+        assert len(cursor.fetchmany(3)) == 3
+        assert len(cursor.fetchall()) == 6
+
+        # One second for executing it, and one for each fetch
+        [(recorded, _)] = g.statements
+        assert recorded == 4
+
+
+def test_statement_time_includes_iterating(app, clock):
+    with app.test_request_context():
+        instrumentation.start_request()
+
+        assert sum(row["number"] for row in get_database().execute(TEN_ROWS)) == 55
+
+        # One second for executing it, and one for each row and for finding there are no more
+        [(recorded, _)] = g.statements
+        assert recorded == 1 + 10 + 1
+
+
+def test_statements_not_recorded_outside_requests(app):
+    with app.app_context():
+        cursor = get_database().execute(TEN_ROWS)
+
+        assert cursor.record is None
+        assert len(cursor.fetchall()) == 10
+
+
+def test_server_timing_header(client):
+    response = client.get("/")
+    timing = response.headers["Server-Timing"]
+
+    assert re.search(r'sql;dur=\d+\.\d;desc="[1-9]\d* statements"', timing)
+    assert re.search(r"template;dur=\d+\.\d", timing)
+    assert re.search(r"total;dur=\d+\.\d", timing)
+
+
+def test_sql_time_is_added_up_after_fetching(app):
+    with app.test_request_context("/"):
+        instrumentation.start_request()
+        get_database().execute(TEN_ROWS).fetchall()
+        recorded = g.statements[0][0]
+
+        response = instrumentation.finish_request(app.response_class())
+
+        assert recorded > 0
+        assert g.timings["sql"] == recorded
+        assert 'desc="1 statements"' in response.headers["Server-Timing"]
+
+
+def test_metrics_only_served_to_allowed_addresses(app):
+    client = app.test_client()
+
+    assert client.get("/metrics").status_code == 200
+    assert client.get("/metrics", environ_base={"REMOTE_ADDR": "203.0.113.5"}).status_code == 404
+
+
+def test_metrics_need_token_once_configured(make_app):
+    client = make_app(INSTRUMENTATION=True, METRICS_TOKEN="secret").test_client()
+
+    assert client.get("/metrics").status_code == 404
+    assert client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code == 404
+
+    response = client.get("/metrics", headers={"Authorization": "Bearer secret"},
+                          environ_base={"REMOTE_ADDR": "203.0.113.5"})
+
+    assert response.status_code == 200
+    assert b"mac_sql_statements_total" in response.data
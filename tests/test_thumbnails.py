@@ -0,0 +1,69 @@
+import os
+
+from mac import thumbnails
+from mac.db import get_database
+
+
+def add_releases(app, stub, count):
+    """Add releases whose images are served by the stub ANN API, each a different image."""
+
+    with app.app_context():
+        database = get_database()
+        database.executemany("INSERT INTO anime_releases (release_id, anime_id, release_title, disc_type, release_date, image) "
+                             "VALUES (?, 1, ?, 'DVD', '2020-01-01', ?)",
+                             [(number, f"Release {number}", f"{stub.url}?anime={number}")
+                              for number in range(1, count + 1)])
+        database.commit()
+
+
+def test_eviction_looks_through_cache_once_while_it_fits(app, client, stub, monkeypatch):
+    add_releases(app, stub, 30)
+    walks = []
+    walk = os.walk
+
+    def counted_walk(*args, **kwargs):
+        walks.append(args[0])
+        return walk(*args, **kwargs)
+
+    monkeypatch.setattr(thumbnails.os, "walk", counted_walk)
+
+    for number in range(1, 31):
+        assert client.get(f"/thumb/{number}").status_code == 200
+
+    assert len(walks) == 1
+
+
+def test_eviction_keeps_cache_under_its_size(app, client, stub):
+    add_releases(app, stub, 30)
+    image_size = len(client.get("/thumb/1").data)
+    app.config["THUMBNAIL_CACHE_SIZE"] = image_size * 10
+
+    for number in range(2, 31):
+        assert client.get(f"/thumb/{number}").status_code == 200
+
+    images = [name for _, _, files in os.walk(os.path.join(app.instance_path, "thumbnails", "images"))
+              for name in files]
+
+    assert 0 < len(images) <= 11
+
+
+def test_image_evicted_before_sending_is_cached_again(app, client, stub, monkeypatch):
+    add_releases(app, stub, 1)
+    assert client.get("/thumb/1").status_code == 200
+
+    # Another process evicts the image right after this request looked it up
+    lookup = thumbnails.lookup
+
+    def evicted_lookup(release_id):
+        digest = lookup(release_id)
+
+        if digest is not None:
+            os.remove(thumbnails.get_image_path(digest))
+
+        return digest
+
+    monkeypatch.setattr(thumbnails, "lookup", evicted_lookup)
+    response = client.get("/thumb/1")
+
+    assert response.status_code == 200
+    assert len(stub.requests) == 2
@@ -0,0 +1,34 @@
+import pytest
+
+from mac.titles import parse_title, parse_titles
+
+
+@pytest.mark.parametrize(("title", "disc_type", "edition"), [
+    # No parentheses at all
+    ("Cowboy Bebop", "Unknown", "Standard"),
+    ("Edition", "Unknown", "Standard"),
+    # "Edition" leading the title, with nothing before it to name the edition
+    ("Edition Cowboy Bebop (DVD)", "DVD", "Standard"),
+    # The edition in parentheses after the disc type
+    ("Evangelion 1.11 (DVD) (Special Edition)", "DVD", "Special"),
+    ("Paprika (Blu-ray) (25th Anniversary Edition)", "Blu-ray", "Anniversary"),
+    ("Akira (Ultimate edition)", "Unknown", "Ultimate"),
+    # Curly and straight apostrophes, and editions in brackets or braces
+    ("Cowboy Bebop [Collector’s Edition] (Blu-ray)", "Blu-ray", "Collector's"),
+    ("Cowboy Bebop [Collector's Edition] (Blu-ray)", "Blu-ray", "Collector's"),
+    ("Akira (Blu-ray) [Limited Edition]", "Blu-ray", "Limited"),
+    ("Akira (Blu-ray + DVD) {Steelbook Edition}", "Blu-ray + DVD", "Steelbook"),
+    # Editions not in the table are capitalized
+    ("Naruto Box Set 1 (DVD) - Uncut Edition", "DVD", "Uncut"),
+    # Parentheses left open
+    ("Trigun (DVD", "DVD", "Standard"),
+])
+def test_parse_title(title, disc_type, edition):
+    assert parse_title(title) == (disc_type, edition)
+
+
+def test_parse_titles():
+    titles = ["Cowboy Bebop (Blu-ray)", "Akira [Collector's Edition] (DVD)", "Trigun"]
+
+    assert parse_titles(titles) == [("Blu-ray", "Standard"), ("DVD", "Collector's"), ("Unknown", "Standard")]
+    assert parse_titles([]) == []
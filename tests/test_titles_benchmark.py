@@ -0,0 +1,53 @@
+import pytest
+
+from mac.titles import parse_titles
+
+# Needs the pytest-benchmark plugin, run with "python -m pytest tests/test_titles_benchmark.py"
+pytest.importorskip("pytest_benchmark")
+
+# Release titles as they appear in ANN's encyclopedia
+CORPUS = [
+    "Cowboy Bebop Complete Series (Blu-ray)",
+    "Cowboy Bebop Complete Series [Collector's Edition] (Blu-ray)",
+    "Cowboy Bebop: The Movie (DVD)",
+    "Neon Genesis Evangelion Platinum Complete (DVD)",
+    "Evangelion 1.11 You Are (Not) Alone (DVD) (Special Edition)",
+    "Evangelion 2.22 You Can (Not) Advance (Blu-ray + DVD)",
+    "Akira (Blu-ray) [25th Anniversary Edition]",
+    "Akira (4K UHD + Blu-ray) {Steelbook Edition}",
+    "Fullmetal Alchemist: Brotherhood Part 1 (Blu-ray + DVD) [Limited Edition]",
+    "Fullmetal Alchemist: Brotherhood Part 2 (Blu-ray + DVD)",
+    "Attack on Titan Part 1 (Blu-ray) [Limited Edition]",
+    "Attack on Titan Season 2 (Blu-ray + DVD)",
+    "Steins;Gate Complete Series (Blu-ray + DVD) [Limited Edition]",
+    "Mobile Suit Gundam Collection 1 (Blu-ray)",
+    "Mobile Suit Gundam Wing Collection 1 (Blu-ray) [Ultimate Edition]",
+    "Spirited Away (Blu-ray + DVD)",
+    "Princess Mononoke (DVD) (Special Edition)",
+    "Naruto Box Set 1 (DVD) - Uncut Edition",
+    "Naruto Shippuden Set 1 (Blu-ray)",
+    "Sailor Moon Season 1 Part 1 (Blu-ray + DVD) [Limited Edition]",
+    "Your Name. (Blu-ray) [Collector’s Edition]",
+    "Paprika (Blu-ray)",
+    "Trigun Complete Series (Blu-ray + DVD) [Premium Edition]",
+    "Ghost in the Shell (4K UHD) (Steelbook Edition)",
+    "Clannad After Story Complete Collection (DVD)",
+    "Clannad (Blu-ray) [Premium Edition]",
+    "Haruhi Suzumiya Season 1 (DVD) (Deluxe Edition)",
+    "One Piece Collection 1 (DVD)",
+    "Dragon Ball Z Season 1 (Blu-ray)",
+    "Demon Slayer Part 1 (Blu-ray + DVD) [Limited Edition]",
+    "Perfect Blue",
+    "Macross Plus",
+]
+
+
+def test_parse_titles_benchmark(benchmark):
+    titles = CORPUS * 100
+
+    results = benchmark(parse_titles, titles)
+
+    assert len(results) == len(titles)
+
+    # Record the throughput alongside the timings
+    benchmark.extra_info["titles_per_second"] = round(len(titles) / benchmark.stats.stats.mean)